@@ -0,0 +1,91 @@
+import queue
+import threading
+
+# kinds of the events returned by `AnalysisWorker.poll()`
+PROGRESS = "progress"
+DONE = "done"
+CANCELLED = "cancelled"
+ERROR = "error"
+
+
+class AnalysisWorker:
+    """
+    Run the analysis of series in a background thread, one series at a time.
+
+    `algorithm(series, instances)` is a generator which yields its progress
+    (0 to 100) and returns the analysis result. Series are queued with
+    `submit()`, with the instances to analyze, e.g. a snapshot of a series
+    the scan is still adding to, and the progress and results come back as
+    `(kind, SeriesInstanceUID, value)` events from `poll()`, which never
+    blocks, so the GUI event loop can call it on every `window.read()` tick:
+
+    - `(PROGRESS, uid, progress)`
+    - `(DONE, uid, analysis)`
+    - `(CANCELLED, uid, None)`
+    - `(ERROR, uid, exception)`
+
+    A cancelled series stops at its next progress step, or is skipped if it
+    is still queued.
+    """
+
+    def __init__(self, algorithm):
+        self._algorithm = algorithm
+        self._jobs = queue.Queue()
+        self._events = queue.Queue()
+        self._cancelled = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, series, instances):
+        with self._lock:
+            self._cancelled.discard(series.SeriesInstanceUID)
+        self._jobs.put((series, instances))
+
+    def cancel(self, SeriesInstanceUID):
+        with self._lock:
+            self._cancelled.add(SeriesInstanceUID)
+
+    def poll(self):
+        """Return the events posted since the last call"""
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def close(self):
+        self._jobs.put(None)
+
+    def _is_cancelled(self, SeriesInstanceUID):
+        with self._lock:
+            return SeriesInstanceUID in self._cancelled
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            series, instances = job
+            uid = series.SeriesInstanceUID
+            try:
+                self._events.put(self._analyze(series, instances))
+            except Exception as e:
+                self._events.put((ERROR, uid, e))
+
+    def _analyze(self, series, instances):
+        uid = series.SeriesInstanceUID
+        if self._is_cancelled(uid):
+            return CANCELLED, uid, None
+
+        steps = self._algorithm(series, instances)
+        while True:
+            try:
+                progress = next(steps)
+            except StopIteration as stop:
+                return DONE, uid, stop.value
+            self._events.put((PROGRESS, uid, progress))
+            if self._is_cancelled(uid):
+                steps.close()
+                return CANCELLED, uid, None
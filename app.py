@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 import sys
 import os
+import time
+import base64
+import tkinter as tk
+from tkinter import ttk
 import PySimpleGUI as sg
 
-from folder_reader import read_dicomfolder
+from cache import AnalysisCache, ThumbnailCache, VolumeCache
+from analysis_worker import AnalysisWorker, PROGRESS, DONE
+from folder_reader import DicomFolder, Series, insert_instance_record
+from scan_worker import ScanWorker, RECORDS, DONE as SCAN_DONE, ERROR as SCAN_ERROR
+from thumbnail_worker import ThumbnailWorker, DONE as THUMBNAIL_DONE, middle_instance
 from viewer import Viewer
+from volume_worker import (
+    VolumeWorker,
+    PROGRESS as VOLUME_PROGRESS,
+    DONE as VOLUME_DONE,
+    ERROR as VOLUME_ERROR,
+)
 
 """
 Both window and window_viewer can be active at the same time.
@@ -18,17 +32,34 @@ There are three important things to be mentioned about this design pattern:
 treedata = sg.TreeData()
 
 
-def mock_run_algorithm():
+# bump when the algorithm changes, to invalidate the cached analysis results
+MOCK_ALGORITHM_VERSION = "mock-1"
+
+
+def mock_run_algorithm(series, instances):
     print(f"start running algorithm")
     count = 100
     for i in range(count):
         print(f"run {i}")
+        time.sleep(0.05)
         progress = i / count * 100
         yield progress
     print(f"end running algorithm")
 
+    # a mock ROI in the middle slice
+    return {"rois": [{"slice": len(instances) // 2, "bbox": (100, 100, 200, 200)}]}
+
+
+def _thumbnail_icon(png):
+    """Tk reads the PNG of a tree icon as base64"""
+    return base64.b64encode(png)
 
-def dicomfolder_to_treedata(dicomfolder):
+
+def dicomfolder_to_treedata(dicomfolder, thumbnails=None):
+    """
+    Build the tree of `dicomfolder`, the series nodes with their thumbnail
+    as icon if it is in the `ThumbnailCache` `thumbnails`.
+    """
     treedata = sg.TreeData()
     treedata.Insert("", "patient", "patient", [])
 
@@ -56,10 +87,151 @@ def dicomfolder_to_treedata(dicomfolder):
                 series_number = series.SeriesNumber
                 series_description = series.SeriesDescription
                 series_text = f"{series_uid} ({len(series.children)} instances)"
-                treedata.Insert("series", series_uid, series_text, [series])
+                png = None
+                if thumbnails is not None and series.children:
+                    png = thumbnails.get(middle_instance(series))
+                treedata.Insert(
+                    "series",
+                    series_uid,
+                    series_text,
+                    [series],
+                    icon=_thumbnail_icon(png) if png else None,
+                )
+    return treedata
+
+
+# key suffix of the dummy child which makes a lazy tree node expandable
+PLACEHOLDER = "+PLACEHOLDER+"
+
+
+def dicomfolder_to_lazy_treedata(dicomfolder):
+    """
+    Like `dicomfolder_to_treedata`, but only the patients are inserted, each
+    with a placeholder child. The studies and series are inserted by
+    `expand_lazy_node` when their parent is expanded, so the initial tree
+    does not grow with the size of the archive.
+    """
+    treedata = sg.TreeData()
+    for patient in dicomfolder.patient_records:
+        patient_id = patient.PatientID
+        treedata.Insert("", patient_id, patient_id, [])
+        treedata.Insert(patient_id, patient_id + PLACEHOLDER, "...", [])
     return treedata
 
 
+def _tree_insert(tree, parent, key, text, values):
+    """Insert a node in both the `TreeData` and the displayed `tree`"""
+    tree.TreeData.Insert(parent, key, text, values)
+    tree.add_treeview_data(tree.TreeData.tree_dict[key])
+
+
+def _tree_delete(tree, key):
+    """Delete a leaf node from both the `TreeData` and the displayed `tree`"""
+    node = tree.TreeData.tree_dict.pop(key)
+    tree.TreeData.tree_dict[node.parent].children.remove(node)
+    item_id = tree.KeyToID.pop(key)
+    del tree.IdToKey[item_id]
+    tree.TKTreeview.delete(item_id)
+
+
+def expand_lazy_node(tree, dicomfolder, key):
+    """
+    Replace the placeholder of the patient or study node `key` of a lazy
+    tree by its children, looked up in the `DicomFolder` UID index.
+    """
+    if key + PLACEHOLDER not in tree.TreeData.tree_dict:
+        return  # already expanded
+    _tree_delete(tree, key + PLACEHOLDER)
+
+    patient = dicomfolder.get_patient_record(key)
+    if patient is not None:
+        for study in patient.children:
+            study_uid = study.StudyInstanceUID
+            _tree_insert(tree, key, study_uid, study_uid, [])
+            _tree_insert(tree, study_uid, study_uid + PLACEHOLDER, "...", [])
+        return
+
+    study = dicomfolder.get_study(key)
+    if study is not None:
+        for series in study.children:
+            series_uid = series.SeriesInstanceUID
+            _tree_insert(tree, key, series_uid, _series_text(series), [series])
+
+
+def _series_text(series):
+    return f"{series.SeriesInstanceUID} ({len(series.children)} instances)"
+
+
+def set_tree_icon(tree, key, png):
+    """Set the PNG icon of the node `key` of a displayed `tree`"""
+    node = tree.TreeData.tree_dict.get(key)
+    if node is None:
+        return
+    node.icon = _thumbnail_icon(png)
+    photo = tree.image_dict.get(node.icon)
+    if photo is None:
+        # keep a reference, Tk does not
+        photo = tree.image_dict[node.icon] = tk.PhotoImage(data=node.icon)
+    tree.TKTreeview.item(tree.KeyToID[key], image=photo)
+
+
+def show_thumbnails(tree, thumbnail_cache, thumbnail_worker):
+    """
+    Set the icon of the series nodes of `tree` which have none: the cached
+    thumbnails are shown right away, the others are queued on the
+    `ThumbnailWorker` and shown when its `DONE` event arrives.
+    """
+    for key, node in list(tree.TreeData.tree_dict.items()):
+        if node.icon or not (node.values and isinstance(node.values[0], Series)):
+            continue
+        series = node.values[0]
+        instance = middle_instance(series)
+        if instance is None:
+            continue
+        png = thumbnail_cache.get(instance)
+        if png is not None:
+            set_tree_icon(tree, key, png)
+        else:
+            thumbnail_worker.submit(series)
+
+
+def add_records_to_lazy_tree(tree, dicomfolder, records):
+    """
+    Insert scanned `records` into `dicomfolder` and add the nodes they create
+    to a lazy tree: new patients, and the new studies and series of nodes
+    that are already expanded. The instance counts of the series shown are
+    updated.
+    """
+    tree_dict = tree.TreeData.tree_dict
+    updated_series = set()
+    for record in records:
+        insert_instance_record(dicomfolder, record)
+        patient_id = record["PatientID"]
+        study_uid = record["StudyInstanceUID"]
+        series_uid = record["SeriesInstanceUID"]
+
+        if patient_id not in tree_dict:
+            _tree_insert(tree, "", patient_id, patient_id, [])
+            _tree_insert(tree, patient_id, patient_id + PLACEHOLDER, "...", [])
+        elif patient_id + PLACEHOLDER in tree_dict:
+            continue  # its studies are inserted when it is expanded
+        elif study_uid not in tree_dict:
+            _tree_insert(tree, patient_id, study_uid, study_uid, [])
+            _tree_insert(tree, study_uid, study_uid + PLACEHOLDER, "...", [])
+        elif study_uid + PLACEHOLDER in tree_dict:
+            continue  # its series are inserted when it is expanded
+        elif series_uid not in tree_dict:
+            series = dicomfolder.get_series(series_uid)
+            _tree_insert(tree, study_uid, series_uid, _series_text(series), [series])
+        else:
+            updated_series.add(series_uid)
+
+    for series_uid in updated_series:
+        text = _series_text(dicomfolder.get_series(series_uid))
+        tree_dict[series_uid].text = text
+        tree.TKTreeview.item(tree.KeyToID[series_uid], text=text)
+
+
 right_click_menu = ["that", ["View", "there", "those"]]
 
 # Window Layout
@@ -70,6 +242,11 @@ layout = [
         sg.InputText(key="_SOURCE_FOLDER_", enable_events=True),
         sg.FolderBrowse(button_text="Scan", target="_SOURCE_FOLDER_"),
     ],
+    [
+        sg.ProgressBar(1, orientation="h", size=(40, 15), key="_SCAN_PROGRESS_"),
+        sg.Text("", size=(60, 1), key="_SCAN_STATUS_"),
+        sg.Button("Cancel Scan", key="_SCAN_CANCEL_"),
+    ],
     # Tree View
     [sg.Text("Tree View")],
     [
@@ -91,116 +268,248 @@ layout = [
             # right_click_menu=right_click_menu,
         ),
     ],
-    [sg.Button("View")],
+    [sg.Button("View"), sg.Button("Analyze")],
 ]
 
-window = sg.Window("DICOM Folder Tree View", layout, size=(1000, 800), finalize=True)
-
-# Custom Binding
-# (tkinter "events"), seeing: https://pysimplegui.readthedocs.io/en/latest/#binding-tkiner-events
-# Double Click On Tree Row
-window["_TREE_"].bind("<Double-Button-1>", "+DOUBLE_CLICK+")
 
-# right click, different for OSX
-if sys.platform == "darwin":
-    # Mac OSX
-    window["_TREE_"].bind("<Button-2>", "+RIGHT_CLICK+")
-else:
-    window["_TREE_"].bind("<Button-3>", "+RIGHT_CLICK+")
+def main():
+    window = sg.Window(
+        "DICOM Folder Tree View", layout, size=(1000, 800), finalize=True
+    )
 
+    # Custom Binding
+    # (tkinter "events"), seeing: https://pysimplegui.readthedocs.io/en/latest/#binding-tkiner-events
+    # Double Click On Tree Row
+    window["_TREE_"].bind("<Double-Button-1>", "+DOUBLE_CLICK+")
+    # Expand a Tree Row, to populate the lazy tree
+    window["_TREE_"].bind("<<TreeviewOpen>>", "+EXPAND+")
 
-window_viewer = None
-
-# Event Loop
-while True:
-    # print("reading window")
-    event, values = window.read(timeout=100)
-    if event != sg.TIMEOUT_KEY:
-        print("> window", event, values)  # debug print
-
-    if event in (None, "Quit"):  # quit app
-        break
-
-    # Catch window `event`
-    if event == "_SOURCE_FOLDER_":  # Scan: choose dicom folder to scan
-        if not values["_SOURCE_FOLDER_"]:
-            sg.Popup("Error", f"please select a folder to scan!")
-            continue
-
-        # Do `Scan` job
-        sg.OneLineProgressMeter(
-            "Scanning DICOM Folder", 0, 2, "_SCAN_METER_", "Scan...", orientation="h"
-        )
-        dicomfolder = read_dicomfolder(values["_SOURCE_FOLDER_"])
-
-        sg.OneLineProgressMeter(
-            "Scanning DICOM Folder", 1, 2, "_SCAN_METER_", "Scan...", orientation="h"
-        )
-        treedata = dicomfolder_to_treedata(dicomfolder)
-
-        sg.OneLineProgressMeter(
-            "Scanning DICOM Folder", 2, 2, "_SCAN_METER_", "Scan...", orientation="h"
-        )
-
-        window["_TREE_"].update(values=treedata)
-
-    elif event in (
-        "View",
-        "_TREE_+DOUBLE_CLICK+",
-    ):  # View: choose one series to launch a viewer window
-        if window_viewer:
-            sg.Popup("Error", f"please close the existing viewer window")
-            continue
-
-        if len(values["_TREE_"]) < 1:
-            sg.Popup("Error", f"please choose a series to view!")
-            continue
-
-        if len(values["_TREE_"]) > 1:
-            sg.Popup("Error", f"Don't choose multiple series to view!")
-            continue
-
-        key = values["_TREE_"][0]
-        node = treedata.tree_dict[key]
-        print(dir(node))
-        if node.parent == "series":
-            # 1. get series data
-            # we should not rely on `treedata`'s data to business logic
-            # we do add `series` data to `node` and can directly retrive it from the values of `node`, so the data structure is based on our defined `Series`
-            series = node.values[0]
-            instances = series.children
-            print(f"view series {node.key} of total {len(instances)} instances")
-
-            # TODO: run algorithm if no cached analysis result for the series
-            for progress in mock_run_algorithm():  # progress is from 0 to 100
-                sg.OneLineProgressMeter(
+    # right click, different for OSX
+    if sys.platform == "darwin":
+        # Mac OSX
+        window["_TREE_"].bind("<Button-2>", "+RIGHT_CLICK+")
+    else:
+        window["_TREE_"].bind("<Button-3>", "+RIGHT_CLICK+")
+
+    thumbnail_cache = ThumbnailCache()
+    thumbnail_worker = ThumbnailWorker(thumbnail_cache)
+    # make the rows tall enough for the thumbnails
+    tree_view = window["_TREE_"].TKTreeview
+    ttk.Style().configure(
+        tree_view.cget("style") or "Treeview", rowheight=thumbnail_cache.size + 4
+    )
+
+    treedata = window["_TREE_"].TreeData
+    dicomfolder = DicomFolder()
+    scan_worker = None
+    window_viewer = None
+    volume_worker = VolumeWorker(VolumeCache())
+    analysis_worker = AnalysisWorker(mock_run_algorithm)
+    analysis_cache = AnalysisCache(MOCK_ALGORITHM_VERSION)
+    # series being analyzed by `analysis_worker`, by SeriesInstanceUID
+    analyzing = {}
+
+    # Event Loop
+    while True:
+        # print("reading window")
+        event, values = window.read(timeout=100)
+        if event != sg.TIMEOUT_KEY:
+            print("> window", event, values)  # debug print
+
+        if event in (None, "Quit"):  # quit app
+            break
+
+        # Catch window `event`
+        if event == "_SOURCE_FOLDER_":  # Scan: choose dicom folder to scan
+            if not values["_SOURCE_FOLDER_"]:
+                sg.Popup("Error", f"please select a folder to scan!")
+                continue
+
+            # Do `Scan` job
+            # the folder is scanned in the background, the tree is filled in as
+            # the files are read
+            if scan_worker is not None:
+                scan_worker.cancel()
+            dicomfolder = DicomFolder()
+            treedata = sg.TreeData()
+            window["_TREE_"].update(values=treedata)
+            scan_worker = ScanWorker(
+                values["_SOURCE_FOLDER_"], workers=None, index=True
+            )
+
+        elif event == "_SCAN_CANCEL_":
+            if scan_worker is not None:
+                scan_worker.cancel()
+
+        elif event == "_TREE_+EXPAND+":  # Expand: populate the lazy tree node
+            tree = window["_TREE_"]
+            expand_lazy_node(tree, dicomfolder, tree.IdToKey[tree.Widget.focus()])
+            # the series are not sorted yet while the scan runs
+            if scan_worker is None:
+                show_thumbnails(tree, thumbnail_cache, thumbnail_worker)
+
+        elif event in (
+            "View",
+            "Analyze",
+            "_TREE_+DOUBLE_CLICK+",
+        ):  # View: choose one series to launch a viewer window, Analyze: only analyze it
+            if window_viewer and event != "Analyze":
+                sg.Popup("Error", f"please close the existing viewer window")
+                continue
+
+            if len(values["_TREE_"]) < 1:
+                sg.Popup("Error", f"please choose a series to view!")
+                continue
+
+            if len(values["_TREE_"]) > 1:
+                sg.Popup("Error", f"Don't choose multiple series to view!")
+                continue
+
+            key = values["_TREE_"][0]
+            node = treedata.tree_dict[key]
+            print(dir(node))
+            if node.values and isinstance(node.values[0], Series):
+                # 1. get series data
+                # we should not rely on `treedata`'s data to business logic
+                # we do add `series` data to `node` and can directly retrive it from the values of `node`, so the data structure is based on our defined `Series`
+                series = node.values[0]
+                # the series may still be growing if the scan is running, the
+                # viewer, the analysis and its cache key use this snapshot
+                series.sort_children()
+                instances = tuple(series.children)
+                print(f"view series {node.key} of total {len(instances)} instances")
+
+                # run algorithm if no cached analysis result for the series
+                # the analysis runs in the background, its overlay is added to the
+                # viewer when it is done
+                analysis = analysis_cache.get(series, instances)
+                print(
+                    f"analysis cache: {analysis_cache.hits} hits, "
+                    f"{analysis_cache.misses} misses"
+                )
+                if analysis is None and series.SeriesInstanceUID not in analyzing:
+                    analyzing[series.SeriesInstanceUID] = series, instances
+                    analysis_worker.submit(series, instances)
+                if event == "Analyze":
+                    continue
+
+                # open a DICOM viewer window right away, on the slices read file
+                # by file, the HU volume (for the coronal and sagittal planes)
+                # is decoded in the background, unless it is cached, and
+                # attached to the viewer when it is done
+                window_viewer = Viewer(series, instances, analysis=analysis)
+                volume_worker.submit(series, instances)
+            else:
+                # sg.Popup("Error", f"please choose a series to view!")
+                continue
+        else:
+            pass
+
+        # handle the scan worker's records and progress
+        if scan_worker is not None:
+            done, total = scan_worker.progress()
+            window["_SCAN_PROGRESS_"].update_bar(done, max(total, 1))
+            window["_SCAN_STATUS_"].update(f"{done}/{total} files scanned")
+
+            for kind, value in scan_worker.poll():
+                if kind == RECORDS:
+                    add_records_to_lazy_tree(window["_TREE_"], dicomfolder, value)
+                elif kind == SCAN_ERROR:
+                    sg.Popup("Error", f"failed to scan the folder: {value}")
+                    scan_worker = None
+                else:  # done or cancelled
+                    if kind == SCAN_DONE:
+                        dicomfolder.sort_patient_records()
+                        show_thumbnails(
+                            window["_TREE_"], thumbnail_cache, thumbnail_worker
+                        )
+                    report = dicomfolder.scan_report = value
+                    window["_SCAN_PROGRESS_"].update_bar(
+                        report.files_done(), max(report.files_total, 1)
+                    )
+                    window["_SCAN_STATUS_"].update(f"{kind}: {report.summary()}")
+                    scan_worker = None
+
+        # show the thumbnails as they are made
+        for kind, series_uid, value in thumbnail_worker.poll():
+            if kind == THUMBNAIL_DONE:
+                set_tree_icon(window["_TREE_"], series_uid, value)
+            else:
+                print(f"thumbnail of {series_uid}: {kind} {value}")
+
+        # handle the analysis worker's progress and results
+        for kind, series_uid, value in analysis_worker.poll():
+            meter_key = f"_ANALYZE_METER_{series_uid}"
+            if kind == PROGRESS:  # progress is from 0 to 100
+                if int(value) < 100 and not sg.OneLineProgressMeter(
                     "Analyzing the series",
-                    int(progress),
+                    int(value),
                     100,
-                    "_ANALYZE_METER_",
-                    "Analyzing...",
+                    meter_key,
+                    f"Analyzing {series_uid}...",
                     orientation="h",
-                )
-
-                pass
-            sg.OneLineProgressMeterCancel("_ANALYZE_METER_")
-
-            # open a DICOM viewer window
-            window_viewer = Viewer(series, instances)
-        else:
-            # sg.Popup("Error", f"please choose a series to view!")
-            continue
-    else:
-        pass
+                ):
+                    # closed by the user
+                    analysis_worker.cancel(series_uid)
+                continue
+
+            sg.OneLineProgressMeterCancel(meter_key)
+            analyzed_series, analyzed_instances = analyzing.pop(series_uid)
+            if kind == DONE:
+                analysis_cache.put(analyzed_series, analyzed_instances, value)
+                if window_viewer and (
+                    window_viewer.series.SeriesInstanceUID == series_uid
+                ):
+                    window_viewer.set_analysis(value)
+            else:
+                print(f"analysis of {series_uid}: {kind} {value}")
+
+        # handle the volume worker's progress and volumes
+        for kind, series_uid, value in volume_worker.poll():
+            if kind == VOLUME_PROGRESS:
+                done, total = value
+                if done < total and not sg.OneLineProgressMeter(
+                    "Loading the series",
+                    done,
+                    total,
+                    "_LOAD_METER_",
+                    "Loading...",
+                    orientation="h",
+                ):
+                    # closed by the user
+                    volume_worker.cancel(series_uid)
+                continue
+
+            sg.OneLineProgressMeterCancel("_LOAD_METER_")
+            if kind == VOLUME_DONE:
+                if window_viewer and (
+                    window_viewer.series.SeriesInstanceUID == series_uid
+                ):
+                    window_viewer.set_volume(value)
+            elif kind == VOLUME_ERROR:
+                # e.g. slices of different sizes, a truncated or deleted file,
+                # the viewer still shows the slices it can read
+                sg.Popup("Error", f"failed to load the series: {value}")
+            else:
+                print(f"volume of {series_uid}: {kind} {value}")
+
+        # handle Viewer's event
+        if window_viewer:
+            ret = window_viewer.event_handler()
 
-    # handle Viewer's event
-    if window_viewer:
-        ret = window_viewer.event_handler()
+            if ret is None:
+                # Viewer is closed, stop loading its volume
+                volume_worker.cancel(window_viewer.series.SeriesInstanceUID)
+                window_viewer = None
 
-        if ret is None:
-            # Viewer is closed
-            window_viewer = None
+    analysis_worker.close()
+    volume_worker.close()
+    thumbnail_worker.close()
+    window.close()
+    del window
 
 
-window.close()
-del window
+# scan workers may re-import this module (spawn start method), so the GUI must
+# only be started when run as a script
+if __name__ == "__main__":
+    main()
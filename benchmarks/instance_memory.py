@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Measure the memory cost of one `Instance`, compared to the previous
+`dict` based record.
+
+python benchmarks/instance_memory.py [count]
+"""
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from folder_reader import Instance
+
+
+class DictInstance(dict):
+    """`Instance` before it was slotted"""
+
+    def __init__(
+        self, filepath, SOPInstanceUID, InstanceNumber, ImagePosition, ImageOrientation
+    ):
+        super().__init__()
+        self.__dict__ = self
+        self.SOPInstanceUID = SOPInstanceUID
+        self.InstanceNumber = InstanceNumber
+        self.ImagePosition = ImagePosition
+        self.ImageOrientation = ImageOrientation
+        self.filepath = filepath
+
+
+def bytes_per_instance(cls, count):
+    # the strings are built first, so only the records and the position and
+    # orientation values they own are measured
+    paths = [f"/data/archive/series_{i // 500}/IM{i:06d}.dcm" for i in range(count)]
+    uids = [f"1.2.826.0.1.3680043.8.498.{i}" for i in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    instances = [
+        cls(
+            paths[i],
+            uids[i],
+            i % 500,
+            [-150.0, -150.0, -0.5 * (i % 500)],
+            [1.0, 0.0, 0.0, 0.0, 1.0, 0.0],
+        )
+        for i in range(count)
+    ]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del instances
+    return size / count
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    before = bytes_per_instance(DictInstance, count)
+    after = bytes_per_instance(Instance, count)
+    print(f"dict Instance:    {before:.0f} bytes per instance")
+    print(f"slotted Instance: {after:.0f} bytes per instance")
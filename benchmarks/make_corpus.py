@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic CT corpus to benchmark the folder scan offline, without
+any patient data: `patients` x `studies` x `series` x `slices` DICOM files of
+`rows` x `columns` int16 pixels, in a `patient/study/series` tree nested
+`depth` directories deeper, with a share of `junk` (non-DICOM) and `corrupt`
+(truncated DICOM) files.
+
+The slices of a series are written in a shuffled order, so the scan has to
+sort them by position.
+
+python benchmarks/make_corpus.py folder [--patients 2] [--slices 100] ...
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+# pydicom 1.4 has no constants for the SOP classes
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+
+def make_slice_template(rows, columns):
+    """Return a CT dataset with a water cylinder phantom as its pixel data"""
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.Modality = "CT"
+    ds.StudyDate = "20200101"
+    ds.StudyTime = "120000"
+    ds.SliceThickness = 1.25
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [0.7, 0.7]
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.RescaleIntercept = -1024
+    ds.RescaleSlope = 1
+
+    y, x = np.ogrid[:rows, :columns]
+    radius = min(rows, columns) * 0.4
+    inside = (y - rows / 2) ** 2 + (x - columns / 2) ** 2 < radius ** 2
+    # air outside (-1000 HU), water inside (0 HU)
+    pixels = np.where(inside, 1024, 24).astype("<i2")
+    ds.PixelData = pixels.tobytes()
+    return ds
+
+
+def make_corpus(
+    folder,
+    patients=2,
+    studies=1,
+    series=2,
+    slices=100,
+    rows=512,
+    columns=512,
+    depth=0,
+    junk=0.0,
+    corrupt=0.0,
+    extension=".dcm",
+    seed=0,
+):
+    """
+    Write the corpus to `folder` and return a summary of it: the number of
+    DICOM, junk and corrupt files and their total size.
+    """
+    rng = np.random.default_rng(seed)
+    ds = make_slice_template(rows, columns)
+    summary = {"dicom_files": 0, "junk_files": 0, "corrupt_files": 0, "bytes": 0}
+    dicom_paths = []
+
+    for p in range(patients):
+        ds.PatientID = f"SYNTH{p:04d}"
+        ds.PatientName = f"Synthetic^Patient{p}"
+        for st in range(studies):
+            ds.StudyInstanceUID = generate_uid()
+            ds.StudyID = str(st + 1)
+            ds.StudyDescription = f"Synthetic study {st + 1}"
+            for se in range(series):
+                ds.SeriesInstanceUID = generate_uid()
+                ds.SeriesNumber = se + 1
+                ds.SeriesDescription = f"Synthetic series {se + 1}"
+                directory = os.path.join(
+                    folder,
+                    f"P{p:04d}",
+                    f"ST{st:03d}",
+                    f"SE{se:03d}",
+                    *(f"D{d}" for d in range(depth)),
+                )
+                os.makedirs(directory, exist_ok=True)
+                for i, n in enumerate(rng.permutation(slices)):
+                    ds.SOPInstanceUID = generate_uid()
+                    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+                    ds.InstanceNumber = int(n) + 1
+                    ds.ImagePositionPatient = [
+                        -columns * 0.35,
+                        -rows * 0.35,
+                        -1.25 * int(n),
+                    ]
+                    path = os.path.join(directory, f"IM{i:05d}{extension}")
+                    ds.save_as(path, write_like_original=False)
+                    dicom_paths.append(path)
+
+    for path in dicom_paths:
+        summary["bytes"] += os.path.getsize(path)
+    summary["dicom_files"] = len(dicom_paths)
+
+    # truncate some files in the middle, like an interrupted copy
+    for path in rng.choice(dicom_paths, int(len(dicom_paths) * corrupt), replace=False):
+        size = os.path.getsize(path)
+        with open(path, "r+b") as fp:
+            fp.truncate(int(rng.integers(0, size)))
+        summary["corrupt_files"] += 1
+
+    # scatter non-DICOM files next to the images, half of them named like one
+    directories = sorted({os.path.dirname(path) for path in dicom_paths})
+    for j in range(int(len(dicom_paths) * junk)):
+        directory = directories[int(rng.integers(len(directories)))]
+        name = f"JUNK{j:05d}{extension}" if j % 2 else f"notes{j:05d}.txt"
+        with open(os.path.join(directory, name), "wb") as fp:
+            fp.write(rng.bytes(int(rng.integers(16, 4096))))
+        summary["junk_files"] += 1
+
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("folder")
+    parser.add_argument("--patients", type=int, default=2)
+    parser.add_argument("--studies", type=int, default=1)
+    parser.add_argument("--series", type=int, default=2)
+    parser.add_argument("--slices", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=512)
+    parser.add_argument("--columns", type=int, default=512)
+    parser.add_argument("--depth", type=int, default=0)
+    parser.add_argument("--junk", type=float, default=0.0)
+    parser.add_argument("--corrupt", type=float, default=0.0)
+    parser.add_argument("--extension", default=".dcm")
+    parser.add_argument("--seed", type=int, default=0)
+    args = vars(parser.parse_args())
+    json.dump(make_corpus(args.pop("folder"), **args), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Time the scan of a folder and print the results as JSON, to track the
+throughput across changes:
+
+- `scan`: `read_dicomfolder`, files/s and MB/s of the scanned files
+- `treedata`: `dicomfolder_to_treedata` of the scanned folder
+- `volume`: `load_series_volume` of its largest series which loads, slices/s
+  and MB/s
+
+Each phase also reports the peak RSS of the process (and of the worker
+processes) after it ran. With `--generate` the folder is first filled with a
+synthetic corpus, see `make_corpus.py`.
+
+python benchmarks/scan_benchmark.py folder [--workers 4] [--output results.json]
+python benchmarks/scan_benchmark.py /tmp/corpus --generate --slices 200
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import platform
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# keep stdout for the JSON, `folder_reader` prints the pydicom version
+with contextlib.redirect_stdout(sys.stderr):
+    from app import dicomfolder_to_treedata
+    from folder_reader import read_dicomfolder
+    from volume_loader import load_series_volume
+from make_corpus import make_corpus
+
+MB = 2 ** 20
+
+
+def peak_rss():
+    """Return the peak RSS of this process and of its children, in bytes"""
+    # kilobytes on Linux, bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+    }
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def benchmark_scan(folder, workers=1, use_threads=False):
+    dicomfolder, seconds = timed(
+        read_dicomfolder, folder, workers=workers, use_threads=use_threads
+    )
+    report = dicomfolder.scan_report
+    files = report.files_done()
+    return (
+        dicomfolder,
+        {
+            "seconds": seconds,
+            "files": files,
+            "files_per_second": files / seconds,
+            "mb_per_second": report.file_bytes / MB / seconds,
+            "report": report,
+            "peak_rss": peak_rss(),
+        },
+    )
+
+
+def benchmark_treedata(dicomfolder):
+    _, seconds = timed(dicomfolder_to_treedata, dicomfolder)
+    return {
+        "seconds": seconds,
+        "series": sum(
+            len(study.children)
+            for patient in dicomfolder.patient_records
+            for study in patient.children
+        ),
+        "peak_rss": peak_rss(),
+    }
+
+
+def benchmark_volume(dicomfolder, workers=None):
+    """
+    Time loading the largest series which loads: a slice truncated in its
+    PixelData passes the scan but not the decoding, the series skipped for
+    that are listed in `errors`.
+    """
+    all_series = sorted(
+        (
+            series
+            for patient in dicomfolder.patient_records
+            for study in patient.children
+            for series in study.children
+        ),
+        key=lambda series: len(series.children),
+        reverse=True,
+    )
+    errors = []
+    for series in all_series:
+        try:
+            volume, seconds = timed(
+                load_series_volume, series.children, workers=workers
+            )
+        except Exception as e:
+            errors.append(
+                {
+                    "series": series.SeriesInstanceUID,
+                    "error": f"{type(e).__name__}: {e}",
+                }
+            )
+            continue
+        return {
+            "seconds": seconds,
+            "slices": len(series.children),
+            "shape": list(volume.shape),
+            "slices_per_second": len(series.children) / seconds,
+            "mb_per_second": volume.nbytes / MB / seconds,
+            "peak_rss": peak_rss(),
+            "errors": errors,
+        }
+    return {"errors": errors} if errors else None
+
+
+def run(folder, workers=1, use_threads=False, volume_workers=None):
+    dicomfolder, scan = benchmark_scan(folder, workers, use_threads)
+    return {
+        "folder": os.path.abspath(folder),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "workers": workers,
+        "use_threads": use_threads,
+        "phases": {
+            "scan": scan,
+            "treedata": benchmark_treedata(dicomfolder),
+            "volume": benchmark_volume(dicomfolder, volume_workers),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("folder")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="scan workers, 0 for one per CPU"
+    )
+    parser.add_argument("--use-threads", action="store_true")
+    parser.add_argument("--volume-workers", type=int, default=None)
+    parser.add_argument("--output", help="write the JSON to a file")
+    parser.add_argument("--generate", action="store_true")
+    for name in ("patients", "studies", "series", "slices", "rows", "columns"):
+        parser.add_argument(f"--{name}", type=int)
+    parser.add_argument("--depth", type=int)
+    parser.add_argument("--junk", type=float)
+    parser.add_argument("--corrupt", type=float)
+    args = parser.parse_args()
+
+    corpus = None
+    if args.generate:
+        options = {
+            name: getattr(args, name)
+            for name in (
+                "patients",
+                "studies",
+                "series",
+                "slices",
+                "rows",
+                "columns",
+                "depth",
+                "junk",
+                "corrupt",
+            )
+            if getattr(args, name) is not None
+        }
+        corpus, seconds = timed(make_corpus, args.folder, **options)
+        corpus["seconds"] = seconds
+
+    results = run(
+        args.folder, args.workers or None, args.use_threads, args.volume_workers
+    )
+    results["corpus"] = corpus
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output)
+    print(output)
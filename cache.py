@@ -0,0 +1,264 @@
+import os
+import json
+import zlib
+import pickle
+import hashlib
+import sqlite3
+import numpy as np
+
+# Root of all on-disk caches, override with the `CT_IMAGES_CACHE` env var
+CACHE_DIR = os.environ.get(
+    "CT_IMAGES_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "ct_images")
+)
+
+
+def cache_dir(*names):
+    """Return (and create) a directory under `CACHE_DIR`"""
+    path = os.path.join(CACHE_DIR, *names)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class ScanIndex:
+    """
+    A persistent index of the records `read_dicomfolder` parsed in a folder.
+
+    Entries are keyed by file path, size and mtime, so a rescan only has to
+    parse the files that are new or changed since the last scan. Invalid
+    files are indexed too (with a `None` record, or `NOT_DICOM` for the files
+    which are not DICOM at all) to avoid retrying them.
+
+    The index is a SQLite file in `CACHE_DIR`, named after the folder path.
+
+    References:
+    https://docs.python.org/3/library/sqlite3.html
+    """
+
+    def __init__(self, foldername, path=None):
+        if path is None:
+            key = hashlib.sha1(os.path.abspath(foldername).encode()).hexdigest()
+            path = os.path.join(cache_dir("scan_index"), f"{key}.sqlite")
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files "
+                "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, record TEXT)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def check_options(self, **options):
+        """
+        Drop all entries if they were scanned with different `options`, e.g.
+        other extra tags, since their records would not match.
+        """
+        value = json.dumps(options, sort_keys=True)
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'options'"
+        ).fetchone()
+        if row is not None and row[0] == value:
+            return
+        with self._conn:
+            self._conn.execute("DELETE FROM files")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('options', ?)", (value,)
+            )
+
+    def entries(self):
+        """
+        Return a dict of `path: (size, mtime_ns, record)` of all indexed files,
+        `record` is still JSON encoded.
+        """
+        return {
+            path: (size, mtime_ns, record)
+            for path, size, mtime_ns, record in self._conn.execute(
+                "SELECT path, size, mtime_ns, record FROM files"
+            )
+        }
+
+    def update(self, entries):
+        """Add or replace `(path, size, mtime_ns, record)` entries"""
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                (
+                    (path, size, mtime_ns, json.dumps(record))
+                    for path, size, mtime_ns, record in entries
+                ),
+            )
+
+    def remove(self, paths):
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM files WHERE path = ?", ((path,) for path in paths)
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+def _evict_lru(directory, max_bytes, suffix, keep=()):
+    """
+    Delete the least recently used files ending with `suffix` in `directory`
+    until they take at most `max_bytes`. A file's mtime is its last use, the
+    caches touch their files on every hit.
+    """
+    entries = [
+        entry
+        for entry in os.scandir(directory)
+        if entry.name.endswith(suffix) and entry.path not in keep
+    ]
+    entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+    total = sum(entry.stat().st_size for entry in entries) + sum(
+        os.path.getsize(path) for path in keep
+    )
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def files_fingerprint(filepaths):
+    """Hash the paths, sizes and mtimes of `filepaths`"""
+    digest = hashlib.sha1()
+    for filepath in filepaths:
+        st = os.stat(filepath)
+        digest.update(f"{filepath}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+    return digest.hexdigest()
+
+
+class VolumeCache:
+    """
+    A size-bounded LRU cache of series volumes, see `load_series_volume`.
+
+    Volumes are stored as raw `.npy` files keyed by SeriesInstanceUID and a
+    fingerprint of the instance files, and are reopened as read-only
+    `np.memmap`s, so only the slices actually accessed are read from disk.
+
+    References:
+    https://numpy.org/doc/stable/reference/generated/numpy.load.html
+    """
+
+    def __init__(self, directory=None, max_bytes=4 * 2 ** 30):
+        self.directory = directory or cache_dir("volumes")
+        self.max_bytes = max_bytes
+
+    def _path(self, SeriesInstanceUID, instances, dtype):
+        fingerprint = files_fingerprint(instance.filepath for instance in instances)
+        key = hashlib.sha1(
+            f"{SeriesInstanceUID}\0{fingerprint}\0{np.dtype(dtype).str}".encode()
+        ).hexdigest()
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def get(self, SeriesInstanceUID, instances, dtype=np.float32):
+        """Return the cached volume as a `np.memmap`, or `None`"""
+        path = self._path(SeriesInstanceUID, instances, dtype)
+        try:
+            volume = np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return volume
+
+    def put(self, SeriesInstanceUID, instances, volume):
+        path = self._path(SeriesInstanceUID, instances, volume.dtype)
+        # write to a temporary file first, a reader never sees a partial volume
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fp:
+            np.save(fp, volume)
+        os.replace(tmp_path, path)
+        _evict_lru(self.directory, self.max_bytes, ".npy", keep=(path,))
+
+
+class AnalysisCache:
+    """
+    A size-bounded LRU cache of analysis results.
+
+    Results are keyed by SeriesInstanceUID, a hash of the SOPInstanceUIDs of
+    the analyzed instances and the algorithm `version`, and stored as
+    zlib-compressed pickles. `hits` and `misses` count the lookups.
+    """
+
+    def __init__(self, version, directory=None, max_bytes=256 * 2 ** 20):
+        self.version = version
+        self.directory = directory or cache_dir("analysis")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, series, instances):
+        instances = hashlib.sha1(
+            "\0".join(
+                sorted(instance.SOPInstanceUID for instance in instances)
+            ).encode()
+        ).hexdigest()
+        key = hashlib.sha1(
+            f"{series.SeriesInstanceUID}\0{instances}\0{self.version}".encode()
+        ).hexdigest()
+        return os.path.join(self.directory, f"{key}.pickle.z")
+
+    def get(self, series, instances):
+        """Return the cached analysis of the `instances` of `series`, or `None`"""
+        path = self._path(series, instances)
+        try:
+            with open(path, "rb") as fp:
+                analysis = pickle.loads(zlib.decompress(fp.read()))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return analysis
+
+    def put(self, series, instances, analysis):
+        path = self._path(series, instances)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(zlib.compress(pickle.dumps(analysis, pickle.HIGHEST_PROTOCOL)))
+        os.replace(tmp_path, path)
+        _evict_lru(self.directory, self.max_bytes, ".pickle.z", keep=(path,))
+
+
+class ThumbnailCache:
+    """
+    A size-bounded LRU cache of slice thumbnails, see `ThumbnailWorker`.
+
+    Thumbnails are PNG files addressed by the hash of what they are made
+    from: the SOPInstanceUID, path, size and mtime of the slice file and the
+    thumbnail `size`, so a changed file gets a new thumbnail and identical
+    requests share one file.
+    """
+
+    def __init__(self, size=48, directory=None, max_bytes=64 * 2 ** 20):
+        self.size = size
+        self.directory = directory or cache_dir("thumbnails")
+        self.max_bytes = max_bytes
+
+    def _path(self, instance):
+        fingerprint = files_fingerprint([instance.filepath])
+        key = hashlib.sha1(
+            f"{instance.SOPInstanceUID}\0{fingerprint}\0{self.size}".encode()
+        ).hexdigest()
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get(self, instance):
+        """Return the PNG thumbnail of `instance`, or `None`"""
+        try:
+            path = self._path(instance)
+            with open(path, "rb") as fp:
+                png = fp.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return png
+
+    def put(self, instance, png):
+        path = self._path(instance)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(png)
+        os.replace(tmp_path, path)
+        _evict_lru(self.directory, self.max_bytes, ".png", keep=(path,))
@@ -0,0 +1,325 @@
+import os
+import re
+import struct
+from functools import partial
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_file_meta_info
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from folder_reader import UNKNOWN_PATIENT_ID
+
+# SOP Class of a DICOMDIR
+MEDIA_STORAGE_DIRECTORY_STORAGE = "1.2.840.10008.1.3.10"
+
+# (0004,1400) and (0004,1420), the first two elements of every directory
+# record, are patched at these offsets of the encoded record
+NEXT_RECORD_OFFSET = 8
+LOWER_LEVEL_OFFSET = 20
+
+# a File ID has at most 8 components of at most 8 uppercase letters, digits
+# or underscores
+FILE_ID_COMPONENT = re.compile(r"[A-Z0-9_]{1,8}\Z")
+MAX_FILE_ID_COMPONENTS = 8
+
+
+def _element(tag, VR, value):
+    """
+    Encode a data element as explicit VR little endian, which only needs the
+    short (2-byte) length for the VRs of a directory record.
+    """
+    if VR == "UL":
+        data = struct.pack("<I", value)
+    elif VR == "US":
+        data = struct.pack("<H", value)
+    else:
+        if value is None:
+            value = ""
+        elif VR == "DS":
+            value = "\\".join(f"{v:.10g}" for v in value)
+        elif isinstance(value, (list, tuple)):
+            value = "\\".join(value)
+        data = str(value).encode("utf-8")
+        if len(data) % 2:
+            data += b"\0" if VR == "UI" else b" "
+    return struct.pack("<HH2sH", tag >> 16, tag & 0xFFFF, VR.encode(), len(data)) + data
+
+
+def _record(record_type, elements):
+    """
+    Encode a directory record, with placeholder offsets to the next record
+    and to the lower level, see `NEXT_RECORD_OFFSET` and `LOWER_LEVEL_OFFSET`.
+    Text which is not ASCII is written as UTF-8.
+    """
+    elements = [element for element in elements if element[2] is not None]
+    if any(isinstance(value, str) and not value.isascii() for _, _, value in elements):
+        elements.append((0x00080005, "CS", "ISO_IR 192"))
+    elements.sort()
+    return bytearray(
+        b"".join(
+            [
+                _element(0x00041400, "UL", 0),
+                _element(0x00041420, "UL", 0),
+                _element(0x00041430, "CS", record_type),
+            ]
+            + [_element(*element) for element in elements]
+        )
+    )
+
+
+def _required(value, description, strict):
+    """Return a Type 1 (or 1C) value, which `strict` requires to be known"""
+    if not value:
+        if strict:
+            raise ValueError(
+                f"the {description} is unknown, it is required in a DICOMDIR"
+            )
+        return ""
+    return value
+
+
+def _patient_record(patient, number, strict):
+    # the PatientID made up by the scan for files without one is unknown too
+    patient_id = patient.PatientID
+    if patient_id == UNKNOWN_PATIENT_ID and strict:
+        patient_id = None
+    return _record(
+        "PATIENT",
+        [
+            (0x00100010, "PN", patient.PatientName or ""),
+            (
+                0x00100020,
+                "LO",
+                _required(
+                    patient_id, f"PatientID of patient {patient.PatientName}", strict
+                ),
+            ),
+        ],
+    )
+
+
+def _study_record(study, number, strict):
+    uid = study.StudyInstanceUID
+    # a missing StudyID is numbered like the SeriesNumber of a series
+    return _record(
+        "STUDY",
+        [
+            (
+                0x00080020,
+                "DA",
+                _required(study.StudyDate, f"StudyDate of study {uid}", strict),
+            ),
+            (
+                0x00080030,
+                "TM",
+                _required(study.StudyTime, f"StudyTime of study {uid}", strict),
+            ),
+            (0x00080050, "SH", study.AccessionNumber or ""),
+            (0x00081030, "LO", study.StudyDescription or ""),
+            (0x0020000D, "UI", study.StudyInstanceUID),
+            (0x00200010, "SH", study.StudyID or str(number)),
+        ],
+    )
+
+
+def _series_record(series, number, strict):
+    # a series of unknown modality is "OT" (other), and a missing
+    # SeriesNumber is its position in the study
+    return _record(
+        "SERIES",
+        [
+            (0x00080060, "CS", series.Modality or "OT"),
+            (0x0008103E, "LO", series.SeriesDescription),
+            (0x0020000E, "UI", series.SeriesInstanceUID),
+            (
+                0x00200011,
+                "IS",
+                number if series.SeriesNumber is None else series.SeriesNumber,
+            ),
+        ],
+    )
+
+
+def _file_id(filepath, root, strict):
+    file_id = os.path.relpath(filepath, root)
+    if file_id.startswith(os.pardir):
+        raise ValueError(f"{filepath} is not in {root}")
+    file_id = file_id.split(os.sep)
+    if strict and (
+        len(file_id) > MAX_FILE_ID_COMPONENTS
+        or not all(FILE_ID_COMPONENT.match(component) for component in file_id)
+    ):
+        raise ValueError(
+            f"{filepath} is not a valid DICOM File ID: at most "
+            f"{MAX_FILE_ID_COMPONENTS} components of at most 8 uppercase letters, "
+            "digits or underscores"
+        )
+    return file_id
+
+
+def _image_record(instance, number, strict, root):
+    path = instance.filepath
+    # a missing InstanceNumber is the position in the sorted series
+    return _record(
+        "IMAGE",
+        [
+            (0x00041500, "CS", _file_id(instance.filepath, root, strict)),
+            (
+                0x00041510,
+                "UI",
+                _required(instance.SOPClassUID, f"SOPClassUID of {path}", strict),
+            ),
+            (0x00041511, "UI", instance.SOPInstanceUID),
+            (
+                0x00041512,
+                "UI",
+                _required(
+                    instance.TransferSyntaxUID, f"TransferSyntaxUID of {path}", strict
+                ),
+            ),
+            (
+                0x00200013,
+                "IS",
+                number if instance.InstanceNumber is None else instance.InstanceNumber,
+            ),
+            (0x00200032, "DS", instance.ImagePosition),
+            (0x00200037, "DS", instance.ImageOrientation),
+            (0x00280030, "DS", instance.PixelSpacing),
+        ],
+    )
+
+
+def _append_records(records, next_records, lower_records, nodes, encoders, strict):
+    """
+    Append the records of `nodes` and of their descendants to `records` in
+    depth-first order, and link them by index in `next_records` (the next
+    node of the same parent) and `lower_records` (the first child).
+    A node is encoded with its 1-based position among its siblings.
+    Returns the indexes of the first and the last record of `nodes`.
+    """
+    encode, *child_encoders = encoders
+    first = previous = None
+    for number, node in enumerate(nodes, 1):
+        index = len(records)
+        records.append(encode(node, number, strict))
+        next_records.append(None)
+        lower_records.append(None)
+        if previous is None:
+            first = index
+        else:
+            next_records[previous] = index
+        if child_encoders and node.children:
+            lower_records[index], _ = _append_records(
+                records,
+                next_records,
+                lower_records,
+                node.children,
+                child_encoders,
+                strict,
+            )
+        previous = index
+    return first, previous
+
+
+def write_dicomdir(dicomfolder, foldername, filename=None, strict=True):
+    """
+    Write the hierarchy of a `DicomFolder` scanned from `foldername` as a
+    DICOMDIR, by default `foldername/DICOMDIR`, with one PATIENT, STUDY,
+    SERIES and IMAGE directory record per node, see `read_dicomdir_records`
+    for reading it back.
+
+    The records are built from the attributes the scan already gathered, no
+    image file is opened. ImagePositionPatient, ImageOrientationPatient and
+    PixelSpacing are added to the IMAGE records when known, so the DICOMDIR
+    fast path can still sort the slices by position and reformat them.
+
+    The offsets between records depend on the sizes of all the records before
+    them, so the records are first encoded with placeholder offsets, then
+    the offsets are computed from the encoded sizes, patched in, and the file
+    is written in one go.
+
+    The Type 1 attributes of the records are required: a missing StudyID,
+    SeriesNumber or InstanceNumber is replaced by the position of the node
+    among its siblings, and a missing Modality by "OT", but a missing
+    StudyDate, StudyTime, SOPClassUID or TransferSyntaxUID, or a PatientID
+    made up by the scan (`UNKNOWN_PATIENT_ID`), raises a `ValueError`. So
+    does a file ID, the path
+    relative to `foldername`, of more than 8 components or with components
+    that are not at most 8 uppercase letters, digits or underscores, which
+    folders not written by a DICOM media creator rarely follow.
+
+    With `strict=False` such values are written anyway, the unknown ones
+    empty and the file IDs as-is, and the DICOMDIR does not conform to the
+    standard: pydicom and `read_dicomdir_records` read it, some other
+    readers may reject it.
+
+    References:
+    http://dicom.nema.org/medical/dicom/current/output/chtml/part03/sect_F.3.html
+    http://dicom.nema.org/medical/dicom/current/output/chtml/part10/chapter_8.html
+    """
+    if filename is None:
+        filename = os.path.join(foldername, "DICOMDIR")
+
+    records = []
+    next_records = []
+    lower_records = []
+    first, last = _append_records(
+        records,
+        next_records,
+        lower_records,
+        dicomfolder.patient_records,
+        [
+            _patient_record,
+            _study_record,
+            _series_record,
+            partial(_image_record, root=foldername),
+        ],
+        strict,
+    )
+
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = MEDIA_STORAGE_DIRECTORY_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    fp = DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = False
+    write_file_meta_info(fp, file_meta)
+    header = b"\0" * 128 + b"DICM" + fp.getvalue()
+
+    def file_set(first, last):
+        return b"".join(
+            [
+                _element(0x00041130, "CS", ""),
+                _element(0x00041200, "UL", first),
+                _element(0x00041202, "UL", last),
+                _element(0x00041212, "US", 0),
+            ]
+        )
+
+    # the offsets are from the start of the file to the item of a record
+    item_sizes = [8 + len(record) for record in records]
+    positions = []
+    position = len(header) + len(file_set(0, 0)) + 12
+    for size in item_sizes:
+        positions.append(position)
+        position += size
+
+    for record, next_record, lower_record in zip(records, next_records, lower_records):
+        if next_record is not None:
+            struct.pack_into("<I", record, NEXT_RECORD_OFFSET, positions[next_record])
+        if lower_record is not None:
+            struct.pack_into("<I", record, LOWER_LEVEL_OFFSET, positions[lower_record])
+
+    with open(filename, "wb") as fp:
+        fp.write(header)
+        if records:
+            fp.write(file_set(positions[first], positions[last]))
+        else:
+            fp.write(file_set(0, 0))
+        # DirectoryRecordSequence, items of defined length
+        fp.write(struct.pack("<HH2sHI", 0x0004, 0x1220, b"SQ", 0, sum(item_sizes)))
+        for record in records:
+            fp.write(struct.pack("<HHI", 0xFFFE, 0xE000, len(record)))
+            fp.write(record)
+    return filename
@@ -1,25 +1,135 @@
 import os
+import sys
 import json
+import time
+import struct
+import logging
+import multiprocessing
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from functools import partial
+from collections import deque, namedtuple
+import numpy as np
 import pydicom
 from pydicom import dcmread
+from pydicom.filereader import read_dicomdir
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+from cache import ScanIndex
 
 print(pydicom.__version__)
 
+logger = logging.getLogger(__name__)
+
+
+# How to read the PixelData of an instance without decoding it, see
+# `volume_loader.pixel_view`. It is the same for (almost) all the instances
+# of a series, so equal formats are shared, see `Instance`.
+PixelFormat = namedtuple(
+    "PixelFormat",
+    [
+        "Rows",
+        "Columns",
+        "SamplesPerPixel",
+        "BitsAllocated",
+        "PixelRepresentation",
+        "NumberOfFrames",
+        "RescaleSlope",
+        "RescaleIntercept",
+    ],
+)
+_pixel_formats = {}
+
+
+class Instance:
+    """
+    An image in a `Series`.
+
+    There is one per scanned file, so unlike the other nodes it is not a
+    `dict` but a slotted record: attributes only, with positions and
+    orientations stored as tuples. Use `to_dict()`, or `DicomFolder.to_json()`,
+    to serialise it.
+
+    PixelSpacing is the (row, column) spacing in mm, used with the slice
+    spacing of the series to reformat its volume, see `mpr.MPR`.
+
+    SOPClassUID and TransferSyntaxUID are kept for the DICOMDIR, see
+    `dicomdir_writer.write_dicomdir`. They are interned, as they are the same
+    for (almost) all the instances of a series.
+
+    PixelDataOffset and PixelDataLength locate the value of an uncompressed
+    little endian PixelData in the file, and `pixel_format` (a shared
+    `PixelFormat`) describes it, so the pixels can be mapped without
+    parsing the file again, see `volume_loader.pixel_view`. The format is
+    also kept for compressed instances, to size their volume before they
+    are decoded.
+    """
+
+    __slots__ = (
+        "SOPInstanceUID",
+        "InstanceNumber",
+        "ImagePosition",
+        "ImageOrientation",
+        "filepath",
+        "tags",
+        "SOPClassUID",
+        "TransferSyntaxUID",
+        "PixelDataOffset",
+        "PixelDataLength",
+        "pixel_format",
+        "PixelSpacing",
+    )
 
-class Instance(dict):
     def __init__(
-        self, filepath, SOPInstanceUID, InstanceNumber, ImagePosition, ImageOrientation
+        self,
+        filepath,
+        SOPInstanceUID,
+        InstanceNumber,
+        ImagePosition,
+        ImageOrientation,
+        tags=None,
+        SOPClassUID=None,
+        TransferSyntaxUID=None,
+        PixelDataOffset=None,
+        PixelDataLength=None,
+        pixel_format=None,
+        PixelSpacing=None,
     ):
-        super().__init__()
-        self.__dict__ = self
         self.SOPInstanceUID = SOPInstanceUID
         self.InstanceNumber = InstanceNumber
-        self.ImagePosition = ImagePosition
-        self.ImageOrientation = ImageOrientation
+        self.ImagePosition = tuple(ImagePosition) if ImagePosition else None
+        self.ImageOrientation = tuple(ImageOrientation) if ImageOrientation else None
         self.filepath = filepath
+        # values of the extra tags requested from `read_dicomfolder`
+        self.tags = tags
+        self.SOPClassUID = sys.intern(SOPClassUID) if SOPClassUID else None
+        self.TransferSyntaxUID = (
+            sys.intern(TransferSyntaxUID) if TransferSyntaxUID else None
+        )
+        self.PixelDataOffset = PixelDataOffset
+        self.PixelDataLength = PixelDataLength
+        if pixel_format is not None:
+            pixel_format = PixelFormat(*pixel_format)
+            pixel_format = _pixel_formats.setdefault(pixel_format, pixel_format)
+        self.pixel_format = pixel_format
+        self.PixelSpacing = tuple(PixelSpacing) if PixelSpacing else None
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"Instance({self.to_dict()!r})"
 
 
 class Series(dict):
+    # the UID lookup tables are slots rather than items, so they are neither
+    # part of the dict contents nor of its JSON
+    __slots__ = ("__dict__", "_children_by_uid")
+
     def __init__(self, SeriesInstanceUID, SeriesNumber, Modality, SeriesDescription):
         super().__init__()
         self.__dict__ = self
@@ -28,12 +138,68 @@ class Series(dict):
         self.Modality = Modality
         self.SeriesDescription = SeriesDescription
         self.children = []
+        self._children_by_uid = {}
+        # set by `sort_children()`
+        self.slice_spacing = None
+        self.slice_gaps = []
+        self.duplicate_slices = []
 
     def add_child(self, instance):
         self.children.append(instance)
+        self._children_by_uid[instance.SOPInstanceUID] = instance
 
     def sort_children(self):
-        pass
+        """
+        Sort the instances by their position along the slice normal, i.e. the
+        projection of ImagePosition(Patient) onto the cross product of the
+        ImageOrientation(Patient) row and column vectors of the first
+        instance. If any instance lacks the geometry, sort by InstanceNumber.
+
+        With geometry, `slice_spacing` is set to the median distance between
+        slices, `slice_gaps` to the indexes of the slices followed by a gap
+        larger than 1.5 spacings, and `duplicate_slices` to the
+        SOPInstanceUIDs of slices at the position of the previous one.
+        """
+        instances = self.children
+        self.slice_spacing = None
+        self.slice_gaps = []
+        self.duplicate_slices = []
+
+        if not all(
+            instance.ImagePosition
+            and len(instance.ImagePosition) == 3
+            and instance.ImageOrientation
+            and len(instance.ImageOrientation) == 6
+            for instance in instances
+        ):
+            self.children = sorted(
+                instances,
+                key=lambda instance: (
+                    instance.InstanceNumber is None,
+                    instance.InstanceNumber or 0,
+                    instance.filepath,
+                ),
+            )
+            return
+
+        positions = np.array([instance.ImagePosition for instance in instances])
+        orientation = np.array(instances[0].ImageOrientation)
+        normal = np.cross(orientation[:3], orientation[3:])
+        distances = positions @ normal
+        order = np.argsort(distances, kind="stable")
+        self.children = [instances[i] for i in order]
+
+        steps = np.diff(distances[order])
+        duplicates = steps < 1e-3
+        self.duplicate_slices = [
+            self.children[i + 1].SOPInstanceUID for i in np.flatnonzero(duplicates)
+        ]
+        if duplicates.all():
+            # a single position, there is no spacing
+            return
+        spacing = np.median(steps[~duplicates])
+        self.slice_spacing = float(spacing)
+        self.slice_gaps = np.flatnonzero(steps > 1.5 * spacing).tolist()
 
     def __eq__(self, other):
         if isinstance(other, str):
@@ -43,22 +209,49 @@ class Series(dict):
         else:
             return NotImplemented
 
+    def get_child(self, SOPInstanceUID):
+        return self._children_by_uid.get(SOPInstanceUID)
+
 
 class Study(dict):
-    def __init__(self, StudyInstanceUID, StudyID, StudyDate, StudyDescription):
+    __slots__ = ("__dict__", "_children_by_uid")
+
+    def __init__(
+        self,
+        StudyInstanceUID,
+        StudyID,
+        StudyDate,
+        StudyDescription,
+        StudyTime=None,
+        AccessionNumber=None,
+    ):
         super().__init__()
         self.__dict__ = self
         self.StudyInstanceUID = StudyInstanceUID
         self.StudyID = StudyID
         self.StudyDate = StudyDate
         self.StudyDescription = StudyDescription
+        # for the STUDY records of a DICOMDIR
+        self.StudyTime = StudyTime
+        self.AccessionNumber = AccessionNumber
         self.children = []
+        self._children_by_uid = {}
 
     def add_child(self, series):
         self.children.append(series)
+        self._children_by_uid[series.SeriesInstanceUID] = series
 
     def sort_children(self):
-        pass
+        """Sort the series by SeriesNumber, and sort each series"""
+        self.children.sort(
+            key=lambda series: (
+                series.SeriesNumber is None,
+                series.SeriesNumber or 0,
+                series.SeriesInstanceUID,
+            )
+        )
+        for series in self.children:
+            series.sort_children()
 
     def __eq__(self, other):
         if isinstance(other, str):
@@ -69,25 +262,31 @@ class Study(dict):
             return NotImplemented
 
     def get_child(self, SeriesInstanceUID):
-        for series in self.children:
-            if series == SeriesInstanceUID:
-                return series
-        return None
+        return self._children_by_uid.get(SeriesInstanceUID)
 
 
 class Patient(dict):
+    __slots__ = ("__dict__", "_children_by_uid")
+
     def __init__(self, PatientID, PatientName):
         super().__init__()
         self.__dict__ = self
         self.PatientID = PatientID
         self.PatientName = PatientName
         self.children = []
+        self._children_by_uid = {}
 
     def add_child(self, study):
         self.children.append(study)
+        self._children_by_uid[study.StudyInstanceUID] = study
 
     def sort_children(self):
-        pass
+        """Sort the studies by StudyDate, and sort each study"""
+        self.children.sort(
+            key=lambda study: (study.StudyDate or "", study.StudyInstanceUID)
+        )
+        for study in self.children:
+            study.sort_children()
 
     def __eq__(self, other):
         if isinstance(other, str):
@@ -98,148 +297,978 @@ class Patient(dict):
             return NotImplemented
 
     def get_child(self, StudyInstanceUID):
-        for study in self.children:
-            if study == StudyInstanceUID:
-                return study
-        return None
+        return self._children_by_uid.get(StudyInstanceUID)
 
 
 class DicomFolder(dict):
     """
     A class representing all DCM files in a folder, similar to DicomDir
 
+    Besides the patient records, it keeps UID lookup tables of all studies,
+    series and instances in the folder.
+
     References:
     https://pydicom.github.io/pydicom/stable/reference/generated/pydicom.dicomdir.DicomDir.html
     """
 
+    # the scan report is a slot too, so it is not part of the JSON: two scans
+    # of the same folder serialise the same
+    __slots__ = (
+        "__dict__",
+        "_patients",
+        "_studies",
+        "_series",
+        "_instances",
+        "scan_report",
+    )
+
     def __init__(self):
         super().__init__()
         self.__dict__ = self
         self.patient_records = []
+        self.scan_report = None
+        self._patients = {}
+        self._studies = {}
+        self._series = {}
+        self._instances = {}
 
     def add_patient_record(self, patient):
         self.patient_records.append(patient)
+        self._patients[patient.PatientID] = patient
 
     def sort_patient_records(self):
-        pass
+        """Sort the patients by PatientID, and sort each patient"""
+        self.patient_records.sort(key=lambda patient: patient.PatientID)
+        for patient in self.patient_records:
+            patient.sort_children()
 
     def get_patient_record(self, PatientID):
-        for patient_record in self.patient_records:
-            if patient_record == PatientID:
-                return patient_record
+        return self._patients.get(PatientID)
+
+    def get_study(self, StudyInstanceUID):
+        return self._studies.get(StudyInstanceUID)
+
+    def get_series(self, SeriesInstanceUID):
+        return self._series.get(SeriesInstanceUID)
+
+    def get_instance(self, SOPInstanceUID):
+        return self._instances.get(SOPInstanceUID)
+
+    def to_json(self, **kwargs):
+        """Serialise the folder with `json.dumps(**kwargs)`"""
+        return json.dumps(self, default=lambda obj: obj.to_dict(), **kwargs)
+
+    def add_instance(self, instance, series, study, patient):
+        """
+        Add `instance` to the hierarchy under `patient`/`study`/`series`.
+        A parent is only added if the folder has no node with its UID yet,
+        otherwise `instance` goes under the existing node.
+        Returns the series `instance` was added to.
+        """
+        patient_record = self.get_patient_record(patient.PatientID)
+        if patient_record is None:
+            patient_record = patient
+            self.add_patient_record(patient_record)
+
+        study_record = patient_record.get_child(study.StudyInstanceUID)
+        if study_record is None:
+            study_record = study
+            patient_record.add_child(study_record)
+            self._studies[study_record.StudyInstanceUID] = study_record
+
+        series_record = study_record.get_child(series.SeriesInstanceUID)
+        if series_record is None:
+            series_record = series
+            study_record.add_child(series_record)
+            self._series[series_record.SeriesInstanceUID] = series_record
+
+        series_record.add_child(instance)
+        self._instances[instance.SOPInstanceUID] = instance
+        return series_record
+
+
+class ScanReport(dict):
+    """
+    Statistics of the `read_dicomfolder` scan that built a `DicomFolder`
+
+    Time is reported per phase: `walk_seconds` to list the folder,
+    `open_seconds` and `parse_seconds` to open and parse the files (summed
+    over the files, so with several workers they add up to more than the
+    scan took), `insert_seconds` and `sort_seconds` to build the hierarchy.
+    `slowest_files` are the `slowest_count` files that took the longest to
+    open and parse, as `(seconds, filepath)`, slowest first.
+
+    Invalid files are logged at the DEBUG level of the `folder_reader`
+    logger, with the reason.
+    """
+
+    def __init__(self, slowest_count=10):
+        super().__init__()
+        self.__dict__ = self
+        # files found by the walk, set before any file is read
+        self.files_total = 0
+        # files the walk passed over, i.e. the DICOMDIR
+        self.files_skipped = 0
+        self.files_scanned = 0
+        # files rejected by `is_dicom_header` without being parsed
+        self.files_not_dicom = 0
+        self.files_invalid = 0
+        # files with the SOPInstanceUID of a file already scanned, left out
+        self.files_duplicate = 0
+        # files whose record was reused from the `ScanIndex`
+        self.files_cached = 0
+        # files whose record was taken from the DICOMDIR, without opening them
+        self.files_listed = 0
+        # bytes the parser consumed vs. the total size of the scanned files
+        self.bytes_read = 0
+        self.file_bytes = 0
+        self.walk_seconds = 0.0
+        self.open_seconds = 0.0
+        self.parse_seconds = 0.0
+        self.insert_seconds = 0.0
+        self.sort_seconds = 0.0
+        self.total_seconds = 0.0
+        self.slowest_count = slowest_count
+        self.slowest_files = []
+
+    def add_record(self, record, cached=False, stats=None):
+        """
+        Count a record of `read_instance_record`, with the `stats` it filled
+        in if the file was read, or the `NOT_DICOM` record of a `ScanIndex`
+        """
+        if stats is not None:
+            self._add_stats(stats)
+            if stats["not_dicom"]:
+                self.files_not_dicom += 1
+                return
+        if record == NOT_DICOM:
+            self.files_not_dicom += 1
+            return
+        if record is None:
+            self.files_invalid += 1
+            return
+        if cached:
+            self.files_cached += 1
+            return
+        self.files_scanned += 1
+        self.bytes_read += record["bytes_read"]
+        self.file_bytes += record["file_size"]
+
+    def _add_stats(self, stats):
+        self.open_seconds += stats["open_seconds"]
+        self.parse_seconds += stats["parse_seconds"]
+        seconds = stats["open_seconds"] + stats["parse_seconds"]
+        slowest = self.slowest_files
+        if len(slowest) < self.slowest_count or seconds > slowest[-1][0]:
+            slowest.append((seconds, stats["filepath"]))
+            slowest.sort(reverse=True)
+            del slowest[self.slowest_count :]
+        if stats["error"] is not None:
+            logger.debug(
+                "%s is not a valid DICOM file: %s", stats["filepath"], stats["error"]
+            )
+
+    def files_done(self):
+        """Number of files read, reused from the index or listed so far"""
+        return (
+            self.files_scanned
+            + self.files_cached
+            + self.files_listed
+            + self.files_not_dicom
+            + self.files_invalid
+        )
+
+    def bytes_read_per_file(self):
+        return self.bytes_read / self.files_scanned if self.files_scanned else 0
+
+    def summary(self):
+        return (
+            f"{self.files_scanned} files scanned, {self.files_cached} cached, "
+            f"{self.files_listed} listed in DICOMDIR, "
+            f"{self.files_not_dicom} not DICOM, {self.files_invalid} invalid, "
+            f"{self.files_duplicate} duplicate, "
+            f"{self.files_skipped} skipped, "
+            f"{self.bytes_read_per_file():.0f} bytes read per file "
+            f"({self.bytes_read} of {self.file_bytes} bytes), "
+            f"walk {self.walk_seconds:.2f}s, open {self.open_seconds:.2f}s, "
+            f"parse {self.parse_seconds:.2f}s, insert {self.insert_seconds:.2f}s, "
+            f"sort {self.sort_seconds:.2f}s, total {self.total_seconds:.2f}s"
+        )
+
+
+# Tags the folder scan decodes, i.e. everything the `Instance`, `Series`,
+# `Study` and `Patient` constructors need. Any other tag is skipped without
+# being decoded, and parsing stops before PixelData.
+SCAN_TAGS = [
+    # instance attr
+    "SOPInstanceUID",
+    "SOPClassUID",
+    "InstanceNumber",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "ImagePosition",
+    "ImageOrientation",
+    "PixelSpacing",
+    # series attr
+    "SeriesInstanceUID",
+    "SeriesNumber",
+    "Modality",
+    "SeriesDescription",
+    # study attr
+    "StudyInstanceUID",
+    "StudyID",
+    "StudyDate",
+    "StudyTime",
+    "StudyDescription",
+    "AccessionNumber",
+    # patient attr
+    "PatientID",
+    "PatientName",
+    # pixel format attr
+    "Rows",
+    "Columns",
+    "SamplesPerPixel",
+    "BitsAllocated",
+    "PixelRepresentation",
+    "NumberOfFrames",
+    "RescaleSlope",
+    "RescaleIntercept",
+]
+
+# Version of the records returned by `read_instance_record`, bump it when
+# they change so that a `ScanIndex` of older records is rebuilt
+RECORD_VERSION = 6
+
+# Record of a file without the DICM prefix in a `ScanIndex`, where an invalid
+# file has a `None` record, so a rescan counts them the same way
+NOT_DICOM = "not DICOM"
+
+# PatientID of the records of files without one, which groups them under one
+# patient
+UNKNOWN_PATIENT_ID = "Anonymous"
+
+
+def _to_builtin(value):
+    """Convert a pydicom element value to a picklable, JSON-able builtin"""
+    if value is None:
         return None
+    if isinstance(value, pydicom.multival.MultiValue):
+        return [_to_builtin(v) for v in value]
+    # DSfloat, IS, UID... are subclasses of the builtins
+    for builtin in (int, float, str, bytes):
+        if isinstance(value, builtin):
+            return builtin(value)
+    return str(value)
 
-    def add_instance(self, instance):
-        pass
+
+# the VRs a data element may have, see `is_dicom_header`
+VRS = {
+    VR.encode()
+    for VR in (
+        "AE AS AT CS DA DS DT FD FL IS LO LT OB OD OF OL OV OW PN SH SL SQ SS ST SV "
+        "TM UC UI UL UN UR US UT UV"
+    ).split()
+}
 
 
-def read_dicomfolder(foldername):
+def is_dicom_header(header, heuristic=False):
     """
-    Scan a folder for DCM files and return a `DicomFolder`.
-    Similar to `pydicom.filereader.read_dicomdir()`
+    Tell if the first 132 bytes of a file are those of a DICOM file, i.e.
+    a 128-byte preamble followed by "DICM".
+
+    Some files have no preamble and start with the first data element. With
+    `heuristic` they are accepted if it is a little endian element of the
+    File Meta Information (group 0x0002) or of the identifying group 0x0008,
+    with an explicit VR or a plausible implicit VR length.
 
     References:
-    https://pydicom.github.io/pydicom/stable/reference/generated/pydicom.filereader.read_dicomdir.html
-    https://pydicom.github.io/pydicom/stable/reference/generated/pydicom.dicomdir.DicomDir.html
+    http://dicom.nema.org/medical/dicom/current/output/chtml/part10/chapter_7.html
     """
-    dicomfolder = DicomFolder()
-    for root, dirs, files in os.walk(foldername):
-        for file in files:
-            if not file.endswith(".dcm"):
-                continue
-
-            dcmname = os.path.join(root, file)
-            # print(dcmname)
-            try:
-                ds = dcmread(dcmname, force=True)
-                # instance attr
-                SOPInstanceUID = ds.SOPInstanceUID
-                InstanceNumber = (
-                    int(ds.InstanceNumber) if hasattr(ds, "InstanceNumber") else None
-                )
-                ImagePosition = (
-                    ds.ImagePosition if hasattr(ds, "ImagePosition") else None
-                )
-                ImageOrientation = (
-                    ds.ImageOrientation if hasattr(ds, "ImageOrientation") else None
-                )
+    if header[128:132] == b"DICM":
+        return True
+    if not heuristic or len(header) < 8:
+        return False
+    group, element = struct.unpack("<HH", header[:4])
+    if group not in (0x0002, 0x0008) or element > 0x1FFF:
+        return False
+    return header[4:6] in VRS or struct.unpack("<I", header[4:8])[0] < 0x10000
 
-                # series attr
-                SeriesInstanceUID = ds.SeriesInstanceUID
-                SeriesNumber = (
-                    int(ds.SeriesNumber) if hasattr(ds, "SeriesNumber") else None
-                )
-                Modality = ds.Modality if hasattr(ds, "Modality") else None
-                SeriesDescription = (
-                    ds.SeriesDescription if hasattr(ds, "SeriesDescription") else None
-                )
 
-                # study attr
-                StudyInstanceUID = ds.StudyInstanceUID
-                StudyID = ds.StudyID if hasattr(ds, "StudyID") else None
-                StudyDate = ds.StudyDate if hasattr(ds, "StudyDate") else None
-                StudyDescription = (
-                    ds.StudyDescription if hasattr(ds, "StudyDescription") else None
-                )
+def _pixel_data_location(fp, ds):
+    """
+    Return the `(offset, length)` of the PixelData value of `ds`, read from
+    `fp` up to it with `stop_before_pixels`, or `None` if it is not stored
+    as is: big endian, deflated or encapsulated (compressed).
 
-                # patient attr
-                PatientID = ds.PatientID if hasattr(ds, "PatientID") else "Anonymous"
-                PatientName = ds.PatientName if hasattr(ds, "PatientName") else None
-
-                # Insert into dicomfolder
-                instance = Instance(
-                    dcmname,
-                    SOPInstanceUID,
-                    InstanceNumber,
-                    ImagePosition,
-                    ImageOrientation,
+    The element header is 12 bytes in explicit VR (tag, VR, 2 reserved bytes
+    and a 4-byte length) and 8 bytes in implicit VR (tag and length), and an
+    undefined length (0xFFFFFFFF) means the value is encapsulated.
+
+    References:
+    http://dicom.nema.org/medical/dicom/current/output/chtml/part05/chapter_7.html
+    """
+    file_meta = getattr(ds, "file_meta", None)
+    transfer_syntax = file_meta.get("TransferSyntaxUID") if file_meta else None
+    if transfer_syntax not in (ImplicitVRLittleEndian, ExplicitVRLittleEndian):
+        # without meta information pydicom guessed the encoding
+        if transfer_syntax is not None or not ds.is_little_endian:
+            return None
+    offset = fp.tell()
+    header = fp.read(12)
+    if header[:4] != b"\xe0\x7f\x10\x00":
+        return None
+    if ds.is_implicit_VR:
+        length = struct.unpack("<I", header[4:8])[0]
+        offset += 8
+    elif header[4:6] in (b"OB", b"OW"):
+        length = struct.unpack("<I", header[8:12])[0]
+        offset += 12
+    else:
+        return None
+    if length == 0xFFFFFFFF:
+        return None
+    return offset, length
+
+
+def read_instance_record(
+    dcmname, tags=None, header_only=True, heuristic=False, stats=None
+):
+    """
+    Read one DCM file and return a compact record of the attributes needed to
+    build the `DicomFolder` hierarchy, or `None` if it is not a valid DICOM file.
+    If a `stats` dict is given, the seconds spent opening and parsing the file
+    and the reason it is invalid (or `None`) are stored in it, see
+    `ScanReport.add_record`.
+
+    The first 132 bytes are checked with `is_dicom_header(heuristic)` before
+    anything is parsed, so other files are rejected for the cost of one read,
+    and `stats["not_dicom"]` is set.
+
+    The record is a plain `dict` of builtin values, so it is cheap to pickle
+    back from a worker process. Values of the extra `tags` (keywords) are kept
+    in `record["tags"]`.
+
+    With `header_only` only `SCAN_TAGS` and `tags` are decoded and the file is
+    not read past the start of PixelData. `record["bytes_read"]` is how far
+    into the file the parser got. The location of an uncompressed PixelData
+    is then read from its element header, see `_pixel_data_location`.
+    """
+    start = time.perf_counter()
+    opened = None
+    error = None
+    not_dicom = False
+    try:
+        with open(dcmname, "rb") as fp:
+            opened = time.perf_counter()
+            if not is_dicom_header(fp.read(132), heuristic):
+                not_dicom = True
+                return None
+            fp.seek(0)
+            if header_only:
+                ds = dcmread(
+                    fp,
+                    force=True,
+                    stop_before_pixels=True,
+                    specific_tags=SCAN_TAGS + list(tags or []),
                 )
-                patient = dicomfolder.get_patient_record(PatientID)
-                if patient is None:
-                    # print(patient)
-                    series = Series(
-                        SeriesInstanceUID, SeriesNumber, Modality, SeriesDescription
-                    )
-                    study = Study(
-                        StudyInstanceUID, StudyID, StudyDate, StudyDescription
+            else:
+                ds = dcmread(fp, force=True)
+            bytes_read = fp.tell()
+            file_size = os.fstat(fp.fileno()).st_size
+            pixel_data = _pixel_data_location(fp, ds) if header_only else None
+            PixelDataOffset, PixelDataLength = pixel_data or (None, None)
+
+        ImagePosition = ds.get("ImagePositionPatient", ds.get("ImagePosition"))
+        ImageOrientation = ds.get("ImageOrientationPatient", ds.get("ImageOrientation"))
+        return {
+            "filepath": dcmname,
+            "bytes_read": bytes_read,
+            "file_size": file_size,
+            # instance attr
+            "SOPInstanceUID": str(ds.SOPInstanceUID),
+            "InstanceNumber": (
+                int(ds.InstanceNumber) if hasattr(ds, "InstanceNumber") else None
+            ),
+            "ImagePosition": _vector(ImagePosition, 3),
+            "ImageOrientation": _vector(ImageOrientation, 6),
+            "PixelSpacing": _vector(ds.get("PixelSpacing"), 2),
+            "SOPClassUID": str(ds.SOPClassUID) if hasattr(ds, "SOPClassUID") else None,
+            "TransferSyntaxUID": (
+                str(ds.file_meta.TransferSyntaxUID)
+                if hasattr(ds, "file_meta") and "TransferSyntaxUID" in ds.file_meta
+                else None
+            ),
+            "PixelDataOffset": PixelDataOffset,
+            "PixelDataLength": PixelDataLength,
+            # pixel format attr
+            "Rows": int(ds.Rows) if hasattr(ds, "Rows") else None,
+            "Columns": int(ds.Columns) if hasattr(ds, "Columns") else None,
+            "SamplesPerPixel": int(ds.get("SamplesPerPixel", 1)),
+            "BitsAllocated": (
+                int(ds.BitsAllocated) if hasattr(ds, "BitsAllocated") else None
+            ),
+            "PixelRepresentation": int(ds.get("PixelRepresentation", 0)),
+            "NumberOfFrames": int(ds.get("NumberOfFrames", 1) or 1),
+            "RescaleSlope": float(ds.get("RescaleSlope", 1)),
+            "RescaleIntercept": float(ds.get("RescaleIntercept", 0)),
+            # series attr
+            "SeriesInstanceUID": str(ds.SeriesInstanceUID),
+            "SeriesNumber": (
+                int(ds.SeriesNumber) if hasattr(ds, "SeriesNumber") else None
+            ),
+            "Modality": str(ds.Modality) if hasattr(ds, "Modality") else None,
+            "SeriesDescription": (
+                str(ds.SeriesDescription) if hasattr(ds, "SeriesDescription") else None
+            ),
+            # study attr
+            "StudyInstanceUID": str(ds.StudyInstanceUID),
+            "StudyID": str(ds.StudyID) if hasattr(ds, "StudyID") else None,
+            "StudyDate": str(ds.StudyDate) if hasattr(ds, "StudyDate") else None,
+            "StudyTime": str(ds.StudyTime) if hasattr(ds, "StudyTime") else None,
+            "StudyDescription": (
+                str(ds.StudyDescription) if hasattr(ds, "StudyDescription") else None
+            ),
+            "AccessionNumber": (
+                str(ds.AccessionNumber) if hasattr(ds, "AccessionNumber") else None
+            ),
+            # patient attr
+            "PatientID": (
+                str(ds.PatientID) if hasattr(ds, "PatientID") else UNKNOWN_PATIENT_ID
+            ),
+            "PatientName": str(ds.PatientName) if hasattr(ds, "PatientName") else None,
+            # extra attr
+            "tags": {tag: _to_builtin(ds.get(tag)) for tag in tags} if tags else None,
+        }
+    except Exception as e:
+        # besides InvalidDicomError, pydicom raises about anything on a corrupt
+        # or truncated file, and a missing UID is an AttributeError: none of
+        # them must stop the scan
+        error = f"{type(e).__name__}: {e}"
+        return None
+    finally:
+        if stats is not None:
+            end = time.perf_counter()
+            if opened is None:
+                opened = end
+            stats["filepath"] = dcmname
+            stats["open_seconds"] = opened - start
+            stats["parse_seconds"] = end - opened
+            stats["error"] = error
+            stats["not_dicom"] = not_dicom
+
+
+def _dicomdir_value(record, keyword, convert=str):
+    value = record.get(keyword)
+    if value is None or (value == "" and convert is not str):
+        return None
+    return convert(value)
+
+
+def _vector(value, length):
+    """
+    Return a multi-valued DS as a list of `length` floats, or `None` if it is
+    missing or malformed, e.g. a position with 2 values, which is then
+    ignored like a missing one rather than failing the sort of its series
+    """
+    try:
+        values = [float(v) for v in value]
+    except (TypeError, ValueError):
+        return None
+    return values if len(values) == length else None
+
+
+def _dicomdir_vector(record, keyword, length):
+    return _vector(record.get(keyword), length)
+
+
+def read_dicomdir_records(dicomdir):
+    """
+    Return the records of all instances listed in a DICOMDIR, in the format
+    of `read_instance_record`, built from its directory records alone: no
+    image file is opened.
+
+    The attributes come from the PATIENT, STUDY and SERIES records above each
+    instance record, and the file path from its ReferencedFileID, relative to
+    the DICOMDIR. Positions and orientations are only set if the DICOMDIR
+    has them (they are optional in the IMAGE record). Directory records
+    without a referenced file (e.g. private records) are skipped.
+
+    References:
+    https://pydicom.github.io/pydicom/stable/reference/generated/pydicom.filereader.read_dicomdir.html
+    http://dicom.nema.org/medical/dicom/current/output/chtml/part03/sect_F.5.html
+    """
+    root = os.path.dirname(dicomdir)
+    records = []
+    for patient in read_dicomdir(dicomdir).patient_records:
+        for study in patient.children:
+            for series in study.children:
+                for instance in series.children:
+                    file_id = instance.get("ReferencedFileID")
+                    if not file_id:
+                        continue
+                    if isinstance(file_id, str):
+                        file_id = [file_id]
+                    records.append(
+                        {
+                            "filepath": os.path.join(root, *file_id),
+                            # instance attr
+                            "SOPInstanceUID": str(
+                                instance.ReferencedSOPInstanceUIDInFile
+                            ),
+                            "InstanceNumber": _dicomdir_value(
+                                instance, "InstanceNumber", int
+                            ),
+                            "ImagePosition": _dicomdir_vector(
+                                instance, "ImagePositionPatient", 3
+                            ),
+                            "ImageOrientation": _dicomdir_vector(
+                                instance, "ImageOrientationPatient", 6
+                            ),
+                            "PixelSpacing": _dicomdir_vector(
+                                instance, "PixelSpacing", 2
+                            ),
+                            "SOPClassUID": _dicomdir_value(
+                                instance, "ReferencedSOPClassUIDInFile"
+                            ),
+                            "TransferSyntaxUID": _dicomdir_value(
+                                instance, "ReferencedTransferSyntaxUIDInFile"
+                            ),
+                            # series attr
+                            "SeriesInstanceUID": str(series.SeriesInstanceUID),
+                            "SeriesNumber": _dicomdir_value(
+                                series, "SeriesNumber", int
+                            ),
+                            "Modality": _dicomdir_value(series, "Modality"),
+                            "SeriesDescription": _dicomdir_value(
+                                series, "SeriesDescription"
+                            ),
+                            # study attr
+                            "StudyInstanceUID": str(study.StudyInstanceUID),
+                            "StudyID": _dicomdir_value(study, "StudyID"),
+                            "StudyDate": _dicomdir_value(study, "StudyDate"),
+                            "StudyTime": _dicomdir_value(study, "StudyTime"),
+                            "StudyDescription": _dicomdir_value(
+                                study, "StudyDescription"
+                            ),
+                            "AccessionNumber": _dicomdir_value(
+                                study, "AccessionNumber"
+                            ),
+                            # patient attr
+                            "PatientID": (
+                                _dicomdir_value(patient, "PatientID")
+                                or UNKNOWN_PATIENT_ID
+                            ),
+                            "PatientName": _dicomdir_value(patient, "PatientName"),
+                            "tags": None,
+                        }
                     )
-                    patient = Patient(PatientID, PatientName)
-                    dicomfolder.add_patient_record(patient)
-                    patient.add_child(study)
-                    study.add_child(series)
-                    series.add_child(instance)
+    return records
+
+
+def insert_instance_record(dicomfolder, record):
+    """
+    Insert a record returned by `read_instance_record` into `dicomfolder`,
+    creating the patient/study/series nodes it belongs to if they are missing.
+    """
+    instance = Instance(
+        record["filepath"],
+        record["SOPInstanceUID"],
+        record["InstanceNumber"],
+        record["ImagePosition"],
+        record["ImageOrientation"],
+        record["tags"],
+        record["SOPClassUID"],
+        record["TransferSyntaxUID"],
+        # not in the records of a DICOMDIR
+        record.get("PixelDataOffset"),
+        record.get("PixelDataLength"),
+        (
+            [record[name] for name in PixelFormat._fields]
+            if record.get("Rows") is not None
+            else None
+        ),
+        record.get("PixelSpacing"),
+    )
+    series = Series(
+        record["SeriesInstanceUID"],
+        record["SeriesNumber"],
+        record["Modality"],
+        record["SeriesDescription"],
+    )
+    study = Study(
+        record["StudyInstanceUID"],
+        record["StudyID"],
+        record["StudyDate"],
+        record["StudyDescription"],
+        record["StudyTime"],
+        record["AccessionNumber"],
+    )
+    patient = Patient(record["PatientID"], record["PatientName"])
+    dicomfolder.add_instance(instance, series, study, patient)
+    return instance
+
+
+def _read_file(read_record, dcmname):
+    stats = {}
+    return dcmname, read_record(dcmname, stats=stats), stats
+
+
+def _read_chunk(read_record, dcmnames):
+    return [_read_file(read_record, dcmname) for dcmname in dcmnames]
+
+
+def _scan_directory(path, with_stat=False):
+    """
+    List a directory for `walk_folder`: return its files as
+    `(path, size, mtime_ns)` (or `(path, None, None)` without `with_stat`)
+    and its subdirectories. Errors are ignored, like `os.walk` does, and
+    symbolic links to directories are not followed.
+    """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        if with_stat:
+                            # cached by the entry, or free on Windows
+                            st = entry.stat()
+                            files.append((entry.path, st.st_size, st.st_mtime_ns))
+                        else:
+                            files.append((entry.path, None, None))
+                except OSError:
                     continue
+    except OSError:
+        pass
+    return files, subdirs
 
-                study = patient.get_child(StudyInstanceUID)
-                if study is None:
-                    series = Series(
-                        SeriesInstanceUID, SeriesNumber, Modality, SeriesDescription
-                    )
-                    study = Study(
-                        StudyInstanceUID, StudyID, StudyDate, StudyDescription
+
+# Longest wait between two checks of the `cancel` event of `iter_dicomfolder`
+CANCEL_POLL_SECONDS = 0.1
+
+
+def iter_dicomfolder(
+    foldername,
+    workers=1,
+    use_threads=False,
+    chunksize=32,
+    max_pending=None,
+    tags=None,
+    header_only=True,
+    heuristic=False,
+    index=None,
+    report=None,
+    dicomdir=True,
+    check_unlisted=False,
+    walk_workers=8,
+    cancel=None,
+):
+    """
+    Scan a folder for DICOM files and yield the record of every valid one
+    as soon as it is read, see `read_instance_record`.
+
+    The folder is walked with `os.scandir` by `walk_workers` threads, which
+    list the subdirectories in parallel. The files of each directory are
+    queued for the parser as soon as it is listed, so parsing starts with the
+    first directory and overlaps the rest of the walk, and
+    `report.files_total` grows until the walk is done.
+
+    Records reused from the `index` are yielded as the walk finds them, the
+    parsed ones in the order they complete. A record with the SOPInstanceUID
+    of a previous one is counted as a duplicate and left out. At most
+    `max_pending` chunks of `chunksize` files are parsed ahead of the
+    consumer (4 per worker by default), and closing the generator cancels
+    the rest of the scan. So does setting the `threading.Event` `cancel`
+    from another thread, which also stops a scan that yields nothing, e.g.
+    of a folder of non-DICOM files: it is checked at least every
+    `CANCEL_POLL_SECONDS` and after each indexed or DICOMDIR record. The
+    scan statistics are added to `report`, if given.
+
+    If `dicomdir` is set and the folder has a DICOMDIR, the records of the
+    files it lists come first, see `read_dicomdir_records`, and the folder
+    is only walked for unlisted files if `check_unlisted` is set. A DICOMDIR
+    which cannot be read is logged and skipped like any other, and the
+    folder is walked.
+
+    See `read_dicomfolder` for the other arguments.
+    """
+    if report is None:
+        report = ScanReport()
+    seen = set()
+
+    def is_cancelled():
+        return cancel is not None and cancel.is_set()
+
+    def is_duplicate(record):
+        if record["SOPInstanceUID"] in seen:
+            report.files_duplicate += 1
+            return True
+        seen.add(record["SOPInstanceUID"])
+        return False
+
+    listed = set()
+    dicomdir_path = os.path.join(foldername, "DICOMDIR")
+    records = None
+    if dicomdir and os.path.isfile(dicomdir_path):
+        try:
+            records = read_dicomdir_records(dicomdir_path)
+        except Exception as e:
+            # walk the folder instead, where the DICOMDIR is skipped
+            logger.warning("cannot read %s, ignoring it: %s", dicomdir_path, e)
+    if records is not None:
+        listed = {os.path.normpath(record["filepath"]) for record in records}
+        report.files_total = len(records)
+        for record in records:
+            if is_cancelled():
+                return
+            report.files_listed += 1
+            if not is_duplicate(record):
+                yield record
+        if not check_unlisted:
+            return
+
+    read_record = partial(
+        read_instance_record,
+        tags=tags,
+        header_only=header_only,
+        heuristic=heuristic,
+    )
+
+    entries = {}
+    # an index opened here is closed when the scan ends
+    own_index = index is True
+    if index:
+        if own_index:
+            index = ScanIndex(foldername)
+        index.check_options(
+            tags=tags,
+            header_only=header_only,
+            heuristic=heuristic,
+            record_version=RECORD_VERSION,
+        )
+        entries = index.entries()
+    # (size, mtime_ns) of the files to parse, for the index
+    file_stats = {}
+    walked = set()
+    updates = []
+
+    def read_results(results):
+        nonlocal updates
+        for dcmname, record, stats in results:
+            report.add_record(record, stats=stats)
+            if index:
+                updates.append(
+                    (
+                        dcmname,
+                        *file_stats.pop(dcmname),
+                        NOT_DICOM if stats["not_dicom"] else record,
                     )
-                    patient.add_child(study)
-                    study.add_child(series)
-                    series.add_child(instance)
-                    continue
+                )
+                if len(updates) >= 1000:
+                    index.update(updates)
+                    updates = []
+            if record is not None and not is_duplicate(record):
+                yield record
 
-                series = study.get_child(SeriesInstanceUID)
-                if series is None:
-                    series = Series(
-                        SeriesInstanceUID, SeriesNumber, Modality, SeriesDescription
+    start = time.perf_counter()
+    walker = ThreadPoolExecutor(max_workers=walk_workers)
+    walking = {walker.submit(_scan_directory, foldername, bool(index))}
+    parser = None
+    if workers != 1:
+        workers = workers or os.cpu_count()
+        max_pending = max_pending or 4 * workers
+        if use_threads:
+            parser = ThreadPoolExecutor(max_workers=workers)
+        else:
+            # forking from a process with other threads running (e.g. the GUI
+            # and its workers) can copy a lock held by one of them, and
+            # deadlock the child
+            parser = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+    parsing = set()
+    # files listed but not submitted to the parser yet
+    dcmnames = deque()
+    try:
+        while walking or parsing or dcmnames:
+            if is_cancelled():
+                return
+            if parser is None:
+                # parse in this thread, one file per round so the listed
+                # directories are still picked up
+                if dcmnames:
+                    yield from read_results(
+                        [_read_file(read_record, dcmnames.popleft())]
                     )
-                    study.add_child(series)
-                    series.add_child(instance)
+            else:
+                while (
+                    dcmnames
+                    and len(parsing) < max_pending
+                    and (len(dcmnames) >= chunksize or not walking)
+                ):
+                    chunk = [
+                        dcmnames.popleft() for _ in range(min(chunksize, len(dcmnames)))
+                    ]
+                    parsing.add(parser.submit(_read_chunk, read_record, chunk))
+
+            block = parser is not None or not dcmnames
+            if not block:
+                timeout = 0
+            elif cancel is not None:
+                timeout = CANCEL_POLL_SECONDS
+            else:
+                timeout = None
+            done, _ = wait(
+                walking | parsing, timeout=timeout, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if future in parsing:
+                    parsing.remove(future)
+                    yield from read_results(future.result())
                     continue
 
-                series.add_child(instance)
+                walking.remove(future)
+                files, subdirs = future.result()
+                for subdir in subdirs:
+                    walking.add(walker.submit(_scan_directory, subdir, bool(index)))
+                for dcmname, size, mtime_ns in files:
+                    if os.path.basename(dcmname) == "DICOMDIR":
+                        report.files_skipped += 1
+                        continue
+                    if listed and os.path.normpath(dcmname) in listed:
+                        continue
+                    report.files_total += 1
+                    if index:
+                        walked.add(dcmname)
+                        # reuse the indexed record of a file whose size and
+                        # mtime are unchanged
+                        entry = entries.get(dcmname)
+                        if entry is not None and entry[:2] == (size, mtime_ns):
+                            if is_cancelled():
+                                return
+                            record = json.loads(entry[2])
+                            report.add_record(record, cached=True)
+                            if record is None or record == NOT_DICOM:
+                                continue
+                            if not is_duplicate(record):
+                                yield record
+                            continue
+                        file_stats[dcmname] = (size, mtime_ns)
+                    dcmnames.append(dcmname)
+                if not walking:
+                    report.walk_seconds += time.perf_counter() - start
+                    if index:
+                        index.remove(path for path in entries if path not in walked)
+                        entries = walked = None
+    finally:
+        for future in walking | parsing:
+            future.cancel()
+        walker.shutdown()
+        if parser is not None:
+            parser.shutdown()
+        # keep what was parsed even if the scan is stopped early
+        if index:
+            index.update(updates)
+        if own_index:
+            index.close()
+
+
+def build_dicomfolder(records, report=None):
+    """
+    Build a sorted `DicomFolder` from a stream of records, e.g.
+    `iter_dicomfolder()`. The time spent inserting and sorting is added to
+    `report`, if given.
+    """
+    insert_seconds = 0.0
+    dicomfolder = DicomFolder()
+    for record in records:
+        start = time.perf_counter()
+        insert_instance_record(dicomfolder, record)
+        insert_seconds += time.perf_counter() - start
+    start = time.perf_counter()
+    dicomfolder.sort_patient_records()
+    if report is not None:
+        report.insert_seconds += insert_seconds
+        report.sort_seconds += time.perf_counter() - start
+    return dicomfolder
+
+
+def read_dicomfolder(
+    foldername,
+    workers=1,
+    use_threads=False,
+    chunksize=32,
+    tags=None,
+    header_only=True,
+    heuristic=False,
+    index=None,
+    dicomdir=True,
+    check_unlisted=False,
+    walk_workers=8,
+):
+    """
+    Scan a folder for DICOM files and return a `DicomFolder`.
+    Similar to `pydicom.filereader.read_dicomdir()`
+
+    With `workers` > 1 (or `None` for one per CPU) the files are parsed by a
+    process pool, or by a thread pool if `use_threads` is set, which suits
+    I/O-bound network mounts better. Workers only return records, the
+    hierarchy is always built in the calling process. The folder is listed
+    by `walk_workers` threads while the files are parsed, see
+    `iter_dicomfolder`.
+
+    Only the headers are read unless `header_only` is False, see
+    `read_instance_record`. Extra `tags` are kept in `instance.tags`.
+
+    Every file is checked for the "DICM" prefix after its 128-byte preamble,
+    whatever its name, and skipped without being parsed if it has none.
+    With `heuristic`, files without a preamble are accepted if they start
+    like a DICOM data set, see `is_dicom_header`.
+
+    The scan statistics are in `dicomfolder.scan_report`, and its summary is
+    logged at the INFO level of the `folder_reader` logger.
+
+    With `index` (True for the default location, or a `cache.ScanIndex`) the
+    records are kept in a persistent index and only new or changed files are
+    parsed again on the next scan.
+
+    If the folder has a DICOMDIR (and `dicomdir` is set), the hierarchy is
+    built from its records alone, without opening the image files. The
+    files it does not list are only scanned if `check_unlisted` is set.
 
-            except pydicom.errors.InvalidDicomError as e:
-                print(e)
-                print(f"{dcmname} is not a valid DICOM file")
+    This is `build_dicomfolder(iter_dicomfolder(...))`, use `iter_dicomfolder`
+    to process the records while the folder is being scanned.
 
-            # print(filepath, patient_id, patient_name, study_instance_uid, study_id, series_instance_uid, sop_instance_uid, instance_number,
-            #     image_position, image_orientation)
+    References:
+    https://pydicom.github.io/pydicom/stable/reference/generated/pydicom.filereader.read_dicomdir.html
+    https://pydicom.github.io/pydicom/stable/reference/generated/pydicom.dicomdir.DicomDir.html
+    https://docs.python.org/3/library/concurrent.futures.html
+    """
+    start = time.perf_counter()
+    report = ScanReport()
+    dicomfolder = build_dicomfolder(
+        iter_dicomfolder(
+            foldername,
+            workers=workers,
+            use_threads=use_threads,
+            chunksize=chunksize,
+            tags=tags,
+            header_only=header_only,
+            heuristic=heuristic,
+            index=index,
+            report=report,
+            dicomdir=dicomdir,
+            check_unlisted=check_unlisted,
+            walk_workers=walk_workers,
+        ),
+        report,
+    )
+    report.total_seconds = time.perf_counter() - start
+    dicomfolder.scan_report = report
+    logger.info("%s: %s", foldername, report.summary())
     return dicomfolder
 
 
@@ -248,6 +1277,7 @@ if __name__ == "__main__":
     dicom_folder = "./Chest_CT_selected/"
     dicomfolder = read_dicomfolder(dicom_folder)
     print(dicomfolder)
+    print(dicomfolder.scan_report.summary())
 
     # print DicomFolder
     for patient in dicomfolder.patient_records:
@@ -280,4 +1310,3 @@ if __name__ == "__main__":
                     image_position = instance.ImagePosition
                     image_orientation = instance.ImageOrientation
                     # print(f"instance_uid: {instance_uid}, instance_number: {instance_number}, image_position: {image_position}, image_orientation: {image_orientation}")
-
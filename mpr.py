@@ -0,0 +1,138 @@
+import numpy as np
+
+AXIAL = "axial"
+CORONAL = "coronal"
+SAGITTAL = "sagittal"
+PLANES = (AXIAL, CORONAL, SAGITTAL)
+
+# (plane axis, row axis, column axis) of each plane in a (slices, rows,
+# columns) volume
+PLANE_AXES = {AXIAL: (0, 1, 2), CORONAL: (1, 0, 2), SAGITTAL: (2, 0, 1)}
+
+
+def series_spacing(series, instances):
+    """
+    Return the (slice, row, column) spacing in mm of the volume of a sorted
+    series, 1 mm where it is unknown, see `Series.sort_children` and
+    `Instance.PixelSpacing`.
+    """
+    pixel_spacing = instances[0].PixelSpacing if instances else None
+    row_spacing, column_spacing = pixel_spacing or (1.0, 1.0)
+    return (series.slice_spacing or 1.0, row_spacing, column_spacing)
+
+
+class _DisplayAxis:
+    """
+    Map the `count` voxels of `spacing` mm along a volume axis to `size`
+    display pixels of `pixel` mm, nearest neighbour, reversed if `flip`.
+    """
+
+    def __init__(self, count, spacing, pixel, flip=False):
+        self.count = count
+        self.spacing = spacing
+        self.pixel = pixel
+        self.flip = flip
+        self.size = max(int(round(count * spacing / pixel)), 1)
+        indices = np.minimum(
+            ((np.arange(self.size) + 0.5) * pixel / spacing).astype(np.intp),
+            count - 1,
+        )
+        self.indices = count - 1 - indices if flip else indices
+
+    def to_display(self, index):
+        if self.flip:
+            index = self.count - 1 - index
+        return min(int((index + 0.5) * self.spacing / self.pixel), self.size - 1)
+
+    def from_display(self, position):
+        return int(self.indices[min(max(int(position), 0), self.size - 1)])
+
+
+class MPR:
+    """
+    Multi-planar reformat of a `(slices, rows, columns)` volume sorted along
+    the slice normal, see `load_series_volume` and `Series.sort_children`.
+
+    A plane is a strided view of the volume (e.g. `volume[:, row, :]` for a
+    coronal plane), so reformatting copies nothing but the displayed pixels,
+    and a memory-mapped volume is only read where it is sampled. Coronal and
+    sagittal planes are resampled, nearest neighbour, to square pixels of the
+    in-plane spacing, scaled down to fit `max_size` pixels, with the last
+    slice (the most superior one for an axial CT) at the top. The lookup
+    indices of each plane are computed once, so a plane change or a move of
+    the crosshair only costs one fancy-indexing gather.
+
+    Axial planes are the slices as stored, so they line up with the
+    analysis ROIs and with the `SliceProvider` of the `Viewer`.
+
+    `position` is the crosshair, a `(slice, row, column)` voxel.
+    """
+
+    def __init__(self, volume, spacing, max_size=600):
+        self.volume = volume
+        self.spacing = spacing
+        self.position = [count // 2 for count in volume.shape]
+        self._axes = {}
+        for plane, (_, row_axis, column_axis) in PLANE_AXES.items():
+            if plane == AXIAL:
+                self._axes[plane] = (
+                    _DisplayAxis(volume.shape[1], 1, 1),
+                    _DisplayAxis(volume.shape[2], 1, 1),
+                )
+                continue
+            row_mm = volume.shape[row_axis] * spacing[row_axis]
+            column_mm = volume.shape[column_axis] * spacing[column_axis]
+            pixel = max(
+                min(spacing[row_axis], spacing[column_axis]),
+                row_mm / max_size,
+                column_mm / max_size,
+            )
+            self._axes[plane] = (
+                _DisplayAxis(
+                    volume.shape[row_axis],
+                    spacing[row_axis],
+                    pixel,
+                    flip=row_axis == 0,
+                ),
+                _DisplayAxis(volume.shape[column_axis], spacing[column_axis], pixel),
+            )
+
+    def count(self, plane):
+        """Return the number of planes of the volume in that orientation"""
+        return self.volume.shape[PLANE_AXES[plane][0]]
+
+    def index(self, plane):
+        """Return the index of the plane through the crosshair"""
+        return self.position[PLANE_AXES[plane][0]]
+
+    def set_index(self, plane, index):
+        axis = PLANE_AXES[plane][0]
+        self.position[axis] = min(max(index, 0), self.volume.shape[axis] - 1)
+
+    def image(self, plane):
+        """Return the values of the plane through the crosshair, resampled"""
+        index = self.index(plane)
+        if plane == AXIAL:
+            view = self.volume[index]
+        elif plane == CORONAL:
+            view = self.volume[:, index, :]
+        else:
+            view = self.volume[:, :, index]
+        rows, columns = self._axes[plane]
+        return view[np.ix_(rows.indices, columns.indices)]
+
+    def to_display(self, plane):
+        """Return the (y, x) display pixel of the crosshair in a plane"""
+        _, row_axis, column_axis = PLANE_AXES[plane]
+        rows, columns = self._axes[plane]
+        return (
+            rows.to_display(self.position[row_axis]),
+            columns.to_display(self.position[column_axis]),
+        )
+
+    def move_to(self, plane, y, x):
+        """Move the crosshair to the (y, x) display pixel of a plane"""
+        _, row_axis, column_axis = PLANE_AXES[plane]
+        rows, columns = self._axes[plane]
+        self.position[row_axis] = rows.from_display(y)
+        self.position[column_axis] = columns.from_display(x)
@@ -0,0 +1,81 @@
+import queue
+import threading
+import time
+
+from folder_reader import ScanReport, iter_dicomfolder
+
+# kinds of the events returned by `ScanWorker.poll()`
+RECORDS = "records"
+DONE = "done"
+CANCELLED = "cancelled"
+ERROR = "error"
+
+
+class ScanWorker:
+    """
+    Scan a folder with `iter_dicomfolder` in a background thread.
+
+    The records are posted in batches, at most every `batch_interval`
+    seconds, as `(kind, value)` events from `poll()`, which never blocks, so
+    the GUI event loop can apply them to its `DicomFolder` and tree on every
+    `window.read()` tick:
+
+    - `(RECORDS, [record, ...])`
+    - `(DONE, report)`
+    - `(CANCELLED, report)`
+    - `(ERROR, exception)`
+
+    `progress()` returns the number of files read so far and in total.
+    The other arguments are passed to `iter_dicomfolder`.
+    """
+
+    def __init__(self, foldername, batch_interval=0.1, **kwargs):
+        self.foldername = foldername
+        self.batch_interval = batch_interval
+        self.report = ScanReport()
+        self._kwargs = kwargs
+        self._events = queue.Queue()
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def progress(self):
+        return self.report.files_done(), self.report.files_total
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def poll(self):
+        """Return the events posted since the last call"""
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def _run(self):
+        records = iter_dicomfolder(
+            self.foldername, report=self.report, cancel=self._cancelled, **self._kwargs
+        )
+        batch = []
+        start = posted = time.monotonic()
+        try:
+            for record in records:
+                batch.append(record)
+                if self._cancelled.is_set():
+                    break
+                if time.monotonic() - posted >= self.batch_interval:
+                    self._events.put((RECORDS, batch))
+                    batch = []
+                    posted = time.monotonic()
+            self._events.put((RECORDS, batch))
+            self.report.total_seconds = time.monotonic() - start
+            self._events.put(
+                (CANCELLED if self._cancelled.is_set() else DONE, self.report)
+            )
+        except Exception as e:
+            self._events.put((ERROR, e))
+        finally:
+            # stops the parser pool if the scan was cancelled
+            records.close()
@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+
+
+class SliceProvider:
+    """
+    Serve the slices of a series to the `Viewer`.
+
+    Decoded slices are kept in a LRU cache of at most `max_bytes`, and the
+    next `prefetch` slices in the scroll direction are loaded ahead by
+    `workers` background threads. The visible slice is never queued: a miss
+    in `get()` is loaded right away in the calling thread (or awaited if a
+    prefetch of it is already running), and every `get()` replaces the
+    pending prefetches, so a fast scroll does not pile up stale loads.
+
+    The cache holds the decoded HU slices rather than windowed pixels, so a
+    window/level change does not throw it away, see `rendering.apply_window`.
+
+    `load_slice(index)` returns the HU values of a slice, e.g. from a
+    (memory-mapped) series volume or by decoding the instance file.
+    """
+
+    def __init__(
+        self, count, load_slice, max_bytes=256 * 2 ** 20, prefetch=8, workers=2
+    ):
+        self.count = count
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+        self._load_slice = load_slice
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        # slices being loaded by a prefetcher
+        self._loading = {}
+        self._wanted = []
+        self._last_index = None
+        self._direction = 1
+        self._closed = False
+        self._condition = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._prefetcher, daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def get(self, index):
+        """Return the HU values of slice `index`"""
+        with self._condition:
+            hu = self._cache.get(index)
+            if hu is not None:
+                self._cache.move_to_end(index)
+            loading = self._loading.get(index)
+            self._schedule_prefetch(index)
+
+        if hu is None and loading is not None:
+            loading.wait()
+            with self._condition:
+                hu = self._cache.get(index)
+        if hu is None:
+            hu = self._load_slice(index)
+            with self._condition:
+                self._store(index, hu)
+        return hu
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _schedule_prefetch(self, index):
+        if self._last_index is not None and index != self._last_index:
+            self._direction = 1 if index > self._last_index else -1
+        self._last_index = index
+        self._wanted = [
+            i
+            for i in (index + self._direction * k for k in range(1, self.prefetch + 1))
+            if 0 <= i < self.count and i not in self._cache
+        ]
+        self._condition.notify_all()
+
+    def _store(self, index, hu):
+        if index in self._cache:
+            return
+        self._cache[index] = hu
+        self._cache_bytes += hu.nbytes
+        while self._cache_bytes > self.max_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted.nbytes
+
+    def _prefetcher(self):
+        while True:
+            with self._condition:
+                while not self._wanted and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                index = self._wanted.pop(0)
+                if index in self._cache or index in self._loading:
+                    continue
+                loading = self._loading[index] = threading.Event()
+
+            try:
+                hu = self._load_slice(index)
+            except Exception:
+                # the error is raised again if the slice is shown
+                hu = None
+            with self._condition:
+                if hu is not None:
+                    self._store(index, hu)
+                del self._loading[index]
+            loading.set()
@@ -0,0 +1,115 @@
+import io
+import queue
+import threading
+import numpy as np
+from PIL import Image
+
+from rendering import apply_window, to_int16
+from volume_loader import frame_count, read_instance_pixels
+
+# kinds of the events returned by `ThumbnailWorker.poll()`
+DONE = "done"
+ERROR = "error"
+
+# window/level (center, width) of CT thumbnails, the soft tissue window of
+# the `Viewer`; other modalities are windowed on their own value range
+CT_WINDOW = (40, 400)
+
+
+def middle_instance(series):
+    """Return the middle instance of a sorted series, or `None`"""
+    if not series.children:
+        return None
+    return series.children[len(series.children) // 2]
+
+
+def make_thumbnail(series, size=48):
+    """
+    Decode the middle slice of `series` and return it as a PNG of at most
+    `size` x `size` pixels.
+
+    The slice is subsampled before it is rescaled and windowed, so only a
+    fraction of the pixels of an uncompressed slice is read from its file,
+    see `pixel_view`.
+    """
+    instance = middle_instance(series)
+    pixels, slope, intercept = read_instance_pixels(instance)
+    frames = frame_count(instance)
+    if frames > 1:
+        pixels = pixels[frames // 2]
+    if pixels.ndim == 3:  # color, shown as grayscale
+        pixels = pixels.mean(axis=-1)
+
+    step = max(-(-max(pixels.shape) // size), 1)
+    hu = pixels[::step, ::step].astype(np.float32) * slope + intercept
+    if series.Modality == "CT":
+        center, width = CT_WINDOW
+    else:
+        low, high = np.percentile(hu, (1, 99))
+        center, width = (low + high) / 2, max(high - low, 1)
+
+    fp = io.BytesIO()
+    Image.fromarray(apply_window(to_int16(hu), center, width)).save(fp, "PNG")
+    return fp.getvalue()
+
+
+class ThumbnailWorker:
+    """
+    Make the thumbnails of series in a background thread, and store them in
+    a `ThumbnailCache`.
+
+    Series are queued with `submit()`, the most recently submitted first, so
+    the series the user just expanded come before a backlog of others. The
+    thumbnails come back as `(kind, SeriesInstanceUID, value)` events from
+    `poll()`, which never blocks, so the GUI event loop can call it on every
+    `window.read()` tick:
+
+    - `(DONE, uid, png)`
+    - `(ERROR, uid, exception)`
+
+    Series which are already queued are not queued again.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._jobs = queue.LifoQueue()
+        self._events = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, series):
+        with self._lock:
+            if series.SeriesInstanceUID in self._pending:
+                return
+            self._pending.add(series.SeriesInstanceUID)
+        self._jobs.put(series)
+
+    def poll(self):
+        """Return the events posted since the last call"""
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def close(self):
+        self._jobs.put(None)
+
+    def _run(self):
+        while True:
+            series = self._jobs.get()
+            if series is None:
+                return
+            uid = series.SeriesInstanceUID
+            try:
+                png = make_thumbnail(series, self.cache.size)
+                self.cache.put(middle_instance(series), png)
+                self._events.put((DONE, uid, png))
+            except Exception as e:
+                self._events.put((ERROR, uid, e))
+            finally:
+                with self._lock:
+                    self._pending.discard(uid)
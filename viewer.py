@@ -1,49 +1,239 @@
+import time
 import pprint
+from collections import deque
+import numpy as np
 import PySimpleGUI as sg
+from PIL import Image, ImageTk
+
+from mpr import AXIAL, MPR, PLANES, series_spacing
+from rendering import apply_window, to_int16
+from slice_provider import SliceProvider
+from volume_loader import frame_count, read_instance_hu
 
 
 class Viewer:
-    def __init__(self, series, instances, analysis=None):
+    def __init__(self, series, instances, analysis=None, volume=None):
         super().__init__()
         print(pprint.pformat(series))
         self._series = series
         self._instances = instances
         self._analysis = analysis
+        # (slices, rows, columns) HU values of `instances`, see
+        # `load_series_volume`, which may be attached after opening
+        self._volume = volume
+        self._open_slices(volume)
+        self._index = 0
+        # coronal and sagittal planes need the volume, the crosshair is shown
+        # in every plane then
+        self._mpr = None
+        if volume is not None:
+            self._mpr = MPR(volume, series_spacing(series, instances))
+        self._plane = AXIAL
+        # soft tissue window
+        self._center = 40
+        self._width = 400
+        # seconds spent rendering the last frames, see `frame_time()`
+        self.frame_times = deque(maxlen=30)
 
         layout_viewer = [
-            [sg.Text("Viewer")],
+            [sg.Text("Viewer"), sg.Text("", size=(30, 1), key="info")],
             [
                 sg.Graph(
                     canvas_size=(600, 600),
                     graph_bottom_left=(0, 0),
                     graph_top_right=(600, 600),
-                    background_color="red",
+                    background_color="black",
                     key="graph",
-                )
+                ),
+                sg.Slider(
+                    range=(0, max(self._slice_count - 1, 0)),
+                    default_value=0,
+                    orientation="v",
+                    size=(30, 20),
+                    disable_number_display=True,
+                    enable_events=True,
+                    key="slice",
+                ),
+            ],
+            [
+                sg.Button("Prev"),
+                sg.Button("Next"),
+                sg.Combo(
+                    list(PLANES),
+                    default_value=AXIAL,
+                    readonly=True,
+                    disabled=self._mpr is None,
+                    enable_events=True,
+                    key="plane",
+                ),
             ],
             [
-                sg.T("Change circle color to:"),
-                sg.Button("Red"),
-                sg.Button("Blue"),
-                sg.Button("Move"),
+                sg.Text("Level"),
+                sg.Slider(
+                    range=(-1000, 1000),
+                    default_value=self._center,
+                    orientation="h",
+                    enable_events=True,
+                    key="level",
+                ),
+                sg.Text("Window"),
+                sg.Slider(
+                    range=(1, 4000),
+                    default_value=self._width,
+                    orientation="h",
+                    enable_events=True,
+                    key="window",
+                ),
             ],
         ]
 
         window = self._window = sg.Window("Viewer", layout_viewer, finalize=True)
         graph = self._graph = window["graph"]
-        self._items = {
-            "circle": graph.DrawCircle(
-                (75, 75), 25, fill_color="black", line_color="white"
-            ),
-            "line": graph.DrawLine((0, 0), (100, 100)),
-            "oval": graph.DrawOval(
-                (25, 300), (100, 280), fill_color="purple", line_color="purple"
-            ),
-            "point": graph.DrawPoint((75, 75), 10, color="green"),
-            "rectangle": graph.DrawRectangle(
-                (25, 300), (100, 280), line_color="purple"
-            ),
-        }
+        # scroll through the slices with the mouse wheel, different for Linux
+        graph.bind("<MouseWheel>", "+WHEEL+")
+        graph.bind("<Button-4>", "+WHEEL_UP+")
+        graph.bind("<Button-5>", "+WHEEL_DOWN+")
+        # move the crosshair
+        graph.bind("<Button-1>", "+CLICK+")
+
+        # the slice is drawn as one image item, replaced on every update
+        self._photo = None
+        self._image_item = graph.TKCanvas.create_image(0, 0, anchor="nw")
+        # ROIs of the analysis drawn over the current slice, and crosshair
+        self._overlay_items = []
+        self._crosshair_items = []
+        self.show_slice(0)
+
+    @property
+    def series(self):
+        return self._series
+
+    def _open_slices(self, volume):
+        """
+        Serve the axial slices from `volume` if it is loaded, or read them one
+        by one (mapped from the file if uncompressed, see `pixel_view`). They
+        are cached as int16 for the window/level lookup table. The frames of
+        multi-frame instances are slices of their own, as in the volume.
+        """
+        if volume is not None:
+            self._slice_count = volume.shape[0]
+            load_slice = lambda index: to_int16(np.asarray(volume[index]))
+        else:
+            # (instance, frame) of every slice
+            frames = [
+                (instance, frame)
+                for instance in self._instances
+                for frame in range(frame_count(instance))
+            ]
+            self._slice_count = len(frames)
+            load_slice = lambda index: to_int16(
+                read_instance_hu(frames[index][0], frame=frames[index][1])
+            )
+        self._slices = SliceProvider(self._slice_count, load_slice)
+
+    def set_volume(self, volume):
+        """
+        Attach the volume of the series, which may arrive after opening: the
+        slices are served from it, and the coronal and sagittal planes are
+        enabled, through the current slice.
+        """
+        self._volume = volume
+        self._slices.close()
+        self._open_slices(volume)
+        self._mpr = MPR(volume, series_spacing(self._series, self._instances))
+        self._mpr.set_index(AXIAL, self._index)
+        self._window["plane"].update(disabled=False, readonly=True)
+        self._window["slice"].update(range=(0, max(self._count() - 1, 0)))
+        self.show_slice(self._index)
+
+    def set_analysis(self, analysis):
+        """Show the `analysis` of the series, which may arrive after opening"""
+        self._analysis = analysis
+        self.render()
+
+    def _draw_overlay(self):
+        canvas = self._graph.TKCanvas
+        for item in self._overlay_items:
+            canvas.delete(item)
+        self._overlay_items = []
+        # the ROIs are on the axial slices
+        if self._analysis is None or self._plane != AXIAL:
+            return
+        for roi in self._analysis["rois"]:
+            if roi["slice"] == self._index:
+                self._overlay_items.append(
+                    canvas.create_rectangle(*roi["bbox"], outline="yellow")
+                )
+
+    def _draw_crosshair(self, width, height):
+        canvas = self._graph.TKCanvas
+        for item in self._crosshair_items:
+            canvas.delete(item)
+        self._crosshair_items = []
+        if self._mpr is None:
+            return
+        y, x = self._mpr.to_display(self._plane)
+        self._crosshair_items = [
+            canvas.create_line(0, y, width, y, fill="green"),
+            canvas.create_line(x, 0, x, height, fill="green"),
+        ]
+
+    def _count(self):
+        """Return the number of slices in the current plane"""
+        if self._plane == AXIAL:
+            return self._slice_count
+        return self._mpr.count(self._plane)
+
+    def frame_time(self):
+        """Return the mean time to render a frame, in seconds"""
+        return sum(self.frame_times) / len(self.frame_times) if self.frame_times else 0
+
+    def render(self):
+        """
+        Draw the current slice with the current window/level: a lookup table
+        maps the slice to 8-bit pixels, which are blitted to the canvas as a
+        single image. Coronal and sagittal slices are reformatted from the
+        volume, see `MPR`.
+        """
+        start = time.perf_counter()
+        if self._plane == AXIAL:
+            try:
+                hu = self._slices.get(self._index)
+            except Exception as e:
+                # e.g. a truncated or deleted file, read before the volume
+                self._window["info"].update(f"cannot read slice {self._index + 1}: {e}")
+                return
+        else:
+            hu = to_int16(self._mpr.image(self._plane))
+        image = Image.fromarray(apply_window(hu, self._center, self._width))
+        if self._photo is not None and (
+            (self._photo.width(), self._photo.height()) == image.size
+        ):
+            self._photo.paste(image)
+        else:
+            self._photo = ImageTk.PhotoImage(image)
+            self._graph.TKCanvas.itemconfig(self._image_item, image=self._photo)
+        self._draw_overlay()
+        self._draw_crosshair(*image.size)
+        self.frame_times.append(time.perf_counter() - start)
+
+        self._window["info"].update(
+            f"{self._plane} {self._index + 1}/{self._count()}, "
+            f"{self.frame_time() * 1000:.1f} ms/frame"
+        )
+
+    def show_slice(self, index):
+        self._index = min(max(index, 0), self._count() - 1)
+        if self._mpr is not None:
+            self._mpr.set_index(self._plane, self._index)
+        self._window["slice"].update(value=self._index)
+        self.render()
+
+    def show_plane(self, plane):
+        """Switch to the axial, coronal or sagittal plane through the crosshair"""
+        self._plane = plane
+        self._window["slice"].update(range=(0, max(self._count() - 1, 0)))
+        self.show_slice(self._mpr.index(plane))
 
     def event_handler(self):
         event, values = self._window.read(timeout=100)
@@ -55,18 +245,29 @@ class Viewer:
 
         if event in (None, "Exit"):
             print("Closing window_viewer", event)
+            self._slices.close()
             self._window.close()
             return None
 
-        graph = self._graph
-        circle = self._items["circle"]
-        if event == "Blue":
-            graph.TKCanvas.itemconfig(circle, fill="Blue")
-        elif event == "Red":
-            graph.TKCanvas.itemconfig(circle, fill="Red")
-        elif event == "Move":
-            for item in self._items.values():
-                graph.MoveFigure(item, 10, 10)
+        if event == "slice":
+            self.show_slice(int(values["slice"]))
+        elif event in ("Prev", "graph+WHEEL_UP+"):
+            self.show_slice(self._index - 1)
+        elif event in ("Next", "graph+WHEEL_DOWN+"):
+            self.show_slice(self._index + 1)
+        elif event in ("level", "window"):
+            self._center = values["level"]
+            self._width = values["window"]
+            self.render()
+        elif event == "plane":
+            self.show_plane(values["plane"])
+        elif event == "graph+CLICK+" and self._mpr is not None:
+            click = self._graph.user_bind_event
+            self._mpr.move_to(self._plane, click.y, click.x)
+            self.render()
+        elif event == "graph+WHEEL+":
+            delta = self._graph.user_bind_event.delta
+            self.show_slice(self._index - 1 if delta > 0 else self._index + 1)
         else:
             pass
 
@@ -0,0 +1,324 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+from pydicom import dcmread
+from pydicom.encaps import encapsulate, generate_pixel_data_frame
+from pydicom.uid import UncompressedPixelTransferSyntaxes
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, compressed series are decoded by threads
+    shared_memory = None
+
+
+def pixel_view(instance):
+    """
+    Return the pixels of an uncompressed `Instance` as a read-only
+    `np.memmap` of its file, located during the folder scan (see
+    `Instance.PixelDataOffset`), so they are neither parsed nor copied.
+
+    Returns `None` if the instance has no such location, e.g. it is
+    compressed or was read from a DICOMDIR, if the pixels are not plain
+    8/16/32-bit grayscale, or if the file shrank since it was scanned.
+
+    References:
+    https://numpy.org/doc/stable/reference/generated/numpy.memmap.html
+    """
+    pixel_format = instance.pixel_format
+    if (
+        instance.PixelDataOffset is None
+        or pixel_format is None
+        or pixel_format.SamplesPerPixel != 1
+        or pixel_format.BitsAllocated not in (8, 16, 32)
+    ):
+        return None
+    kind = "i" if pixel_format.PixelRepresentation else "u"
+    dtype = np.dtype(f"<{kind}{pixel_format.BitsAllocated // 8}")
+    shape = (pixel_format.Rows, pixel_format.Columns)
+    if pixel_format.NumberOfFrames > 1:
+        shape = (pixel_format.NumberOfFrames, *shape)
+    if np.prod(shape) * dtype.itemsize > instance.PixelDataLength:
+        return None
+    try:
+        return np.memmap(
+            instance.filepath,
+            dtype=dtype,
+            mode="r",
+            offset=instance.PixelDataOffset,
+            shape=shape,
+        )
+    except (OSError, ValueError):
+        return None
+
+
+def read_instance_pixels(instance):
+    """
+    Decode the pixels of an `Instance` and return them with its
+    RescaleSlope and RescaleIntercept.
+
+    Uncompressed pixels are a `pixel_view` of the file, the others are
+    decoded by pydicom.
+    """
+    pixels = pixel_view(instance)
+    if pixels is not None:
+        pixel_format = instance.pixel_format
+        return pixels, pixel_format.RescaleSlope, pixel_format.RescaleIntercept
+
+    ds = dcmread(instance.filepath, force=True)
+    return (
+        ds.pixel_array,
+        float(ds.get("RescaleSlope", 1)),
+        float(ds.get("RescaleIntercept", 0)),
+    )
+
+
+def read_instance_hu(instance, dtype=np.float32, frame=None):
+    """
+    Decode the pixels of an `Instance` and rescale them to HU values, only
+    those of `frame` if given and the instance has several frames, which are
+    otherwise all returned, see `frame_count`.
+    """
+    pixels, slope, intercept = read_instance_pixels(instance)
+    if frame is not None and frame_count(instance) > 1:
+        pixels = pixels[frame]
+    hu = pixels.astype(dtype)
+    return rescale(hu[None], np.array([slope]), np.array([intercept]))[0]
+
+
+def _check_shape(instance, pixels, shape):
+    if pixels.shape != shape:
+        raise ValueError(
+            f"{instance.filepath} is {pixels.shape}, the series slices are {shape}"
+        )
+
+
+def frame_count(instance):
+    """Return the number of frames, 1 if the pixel format is not known"""
+    return instance.pixel_format.NumberOfFrames if instance.pixel_format else 1
+
+
+def _decode_into(volume, first, instance):
+    """Decode the frames of `instance` into the slices from `first` on"""
+    start = time.perf_counter()
+    pixels, slope, intercept = read_instance_pixels(instance)
+    count = frame_count(instance)
+    _check_shape(
+        instance, pixels, volume.shape[1:] if count == 1 else (count, *volume.shape[1:])
+    )
+    volume[first : first + count] = pixels
+    return slope, intercept, time.perf_counter() - start
+
+
+def _is_compressed_syntax(uid):
+    # unlike `UID.is_compressed`, private or unknown syntaxes do not raise
+    return uid not in UncompressedPixelTransferSyntaxes
+
+
+def is_compressed(instance):
+    """
+    Tell if the PixelData of an `Instance` is encapsulated, e.g. JPEG, i.e.
+    its transfer syntax is not one of the uncompressed ones, so a private or
+    unknown syntax is left to the pydicom pixel handlers
+    """
+    return instance.TransferSyntaxUID is not None and _is_compressed_syntax(
+        instance.TransferSyntaxUID
+    )
+
+
+def _decode_frames_into(shm_name, shape, dtype, instance, first, frames):
+    """
+    Decode the `frames` of `instance` into the slices `first + frame` of the
+    `(slices, rows, columns)` volume in the shared memory block `shm_name`,
+    in a worker process. Returns the seconds each frame took.
+
+    A frame of an encapsulated multi-frame instance is decoded on its own,
+    as a single-frame copy of the dataset, so the frames of one instance can
+    be split across the workers.
+    """
+    block = shared_memory.SharedMemory(name=shm_name)
+    volume = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    try:
+        start = time.perf_counter()
+        if instance.pixel_format.NumberOfFrames == 1:
+            pixels, _, _ = read_instance_pixels(instance)
+            _check_shape(instance, pixels, shape[1:])
+            volume[first] = pixels
+            timings = [time.perf_counter() - start]
+        else:
+            ds = dcmread(instance.filepath, force=True)
+            compressed = _is_compressed_syntax(ds.file_meta.TransferSyntaxUID)
+            if compressed:
+                encoded = list(generate_pixel_data_frame(ds.PixelData))
+                ds.NumberOfFrames = 1
+            timings = []
+            for frame in frames:
+                if compressed:
+                    ds.PixelData = encapsulate([encoded[frame]])
+                    pixels = ds.pixel_array
+                else:
+                    pixels = ds.pixel_array[frame]
+                _check_shape(instance, pixels, shape[1:])
+                volume[first + frame] = pixels
+                timings.append(time.perf_counter() - start)
+                start = time.perf_counter()
+    finally:
+        # the block cannot be closed while the array still uses it
+        del volume
+        block.close()
+    return timings
+
+
+def rescale(volume, slopes, intercepts):
+    """
+    Apply the per-slice `slopes` and `intercepts` to `volume` in place, in
+    one vectorised step.
+    """
+    slopes = slopes[:, None, None]
+    intercepts = intercepts[:, None, None]
+    if np.issubdtype(volume.dtype, np.floating):
+        volume *= slopes
+        volume += intercepts
+    elif (slopes == 1).all() and (intercepts == np.round(intercepts)).all():
+        volume += intercepts.astype(volume.dtype)
+    else:
+        volume[...] = np.rint(volume * slopes + intercepts)
+    return volume
+
+
+def _load_compressed_volume(instances, dtype, workers, progress, timings):
+    """
+    `load_series_volume` of a series with compressed instances, by a pool of
+    `workers` processes, as decoding holds the GIL. The volume is allocated
+    in shared memory, where the workers decode the frames in place, so no
+    pixels are pickled back. Multi-frame instances are split in chunks of
+    frames, to spread them across the workers.
+
+    References:
+    https://docs.python.org/3/library/multiprocessing.shared_memory.html
+    """
+    pixel_format = instances[0].pixel_format
+    frame_counts = [instance.pixel_format.NumberOfFrames for instance in instances]
+    firsts = np.cumsum([0] + frame_counts[:-1]).tolist()
+    total = sum(frame_counts)
+    shape = (total, pixel_format.Rows, pixel_format.Columns)
+    slopes = np.repeat(
+        [instance.pixel_format.RescaleSlope for instance in instances], frame_counts
+    )
+    intercepts = np.repeat(
+        [instance.pixel_format.RescaleIntercept for instance in instances],
+        frame_counts,
+    )
+
+    workers = workers or os.cpu_count()
+    tasks = []
+    for instance, first, count in zip(instances, firsts, frame_counts):
+        chunk = -(-count // workers)
+        for start in range(0, count, chunk):
+            tasks.append(
+                (instance, first, list(range(start, min(start + chunk, count))))
+            )
+
+    block = shared_memory.SharedMemory(
+        create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    )
+    volume = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    try:
+        # not forked, see `iter_dicomfolder`
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _decode_frames_into, block.name, shape, dtype, *task
+                ): task
+                for task in tasks
+            }
+            done = 0
+            for future in as_completed(futures):
+                instance, first, frames = futures[future]
+                for frame, seconds in zip(frames, future.result()):
+                    if timings is not None:
+                        timings.append((instance.filepath, frame, seconds))
+                done += len(frames)
+                cancelled = progress is not None and progress(done, total) is False
+                if cancelled and done < total:
+                    for future in futures:
+                        future.cancel()
+                    return None
+        return rescale(np.array(volume), slopes, intercepts)
+    finally:
+        del volume
+        block.close()
+        block.unlink()
+
+
+def load_series_volume(
+    instances, dtype=np.float32, workers=None, progress=None, timings=None
+):
+    """
+    Decode the (sorted) `instances` of a series into one preallocated
+    `(slices, rows, columns)` array of `dtype`, and rescale it to HU values.
+
+    The slices are decoded concurrently by a pool of `workers` threads
+    (pydicom and NumPy release the GIL for most of the file reading and
+    copying). Uncompressed slices are copied straight from a `pixel_view` of
+    their file into the volume. If the series has compressed instances (and
+    their pixel format is known from the scan), they are decoded by a pool
+    of processes instead, see `_load_compressed_volume`. Either way, every
+    frame of a multi-frame instance is a slice.
+
+    `progress(done, total)` is called from the calling thread after each
+    slice, so it can update the GUI; if it returns False before the last
+    slice the load is cancelled and `None` is returned. If a `timings` list
+    is given, `(filepath, frame, seconds)` is appended for every frame
+    decoded.
+
+    With an integer `dtype`, e.g. `np.int16`, the rescaled values are rounded.
+    """
+    if (
+        shared_memory is not None
+        and any(is_compressed(instance) for instance in instances)
+        and all(instance.pixel_format is not None for instance in instances)
+    ):
+        return _load_compressed_volume(instances, dtype, workers, progress, timings)
+
+    # the frames of multi-frame instances are slices too
+    total = len(instances)
+    frame_counts = [frame_count(instance) for instance in instances]
+    firsts = np.cumsum([0] + frame_counts[:-1]).tolist()
+    start = time.perf_counter()
+    pixels, slope, intercept = read_instance_pixels(instances[0])
+    if timings is not None:
+        timings.append((instances[0].filepath, 0, time.perf_counter() - start))
+    shape = pixels.shape[1:] if frame_counts[0] > 1 else pixels.shape
+    volume = np.empty((sum(frame_counts), *shape), dtype=dtype)
+    volume[: frame_counts[0]] = pixels
+    slopes = np.ones(total)
+    intercepts = np.zeros(total)
+    slopes[0], intercepts[0] = slope, intercept
+    cancelled = progress is not None and progress(1, total) is False
+    if cancelled and total > 1:
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_decode_into, volume, firsts[i], instance): i
+            for i, instance in enumerate(instances[1:], 1)
+        }
+        for done, future in enumerate(as_completed(futures), 2):
+            i = futures[future]
+            slopes[i], intercepts[i], seconds = future.result()
+            if timings is not None:
+                timings.append((instances[i].filepath, 0, seconds))
+            cancelled = progress is not None and progress(done, total) is False
+            if cancelled and done < total:
+                for future in futures:
+                    future.cancel()
+                return None
+
+    return rescale(
+        volume, np.repeat(slopes, frame_counts), np.repeat(intercepts, frame_counts)
+    )
@@ -0,0 +1,108 @@
+import queue
+import logging
+import threading
+import numpy as np
+
+from rendering import to_int16
+from volume_loader import load_series_volume
+
+logger = logging.getLogger(__name__)
+
+# kinds of the events returned by `VolumeWorker.poll()`
+PROGRESS = "progress"
+DONE = "done"
+CANCELLED = "cancelled"
+ERROR = "error"
+
+
+class VolumeWorker:
+    """
+    Load the volumes of series in a background thread, one series at a time,
+    from a `VolumeCache` or with `load_series_volume`, which are then cached.
+    A loaded volume is posted before it is written to the cache, as int16 HU
+    values, the input of the `Viewer` window/level, at half the size.
+
+    Series are queued with `submit()`, with the sorted instances to load, and
+    the progress and volumes come back as `(kind, SeriesInstanceUID, value)`
+    events from `poll()`, which never blocks, so the GUI event loop can call
+    it on every `window.read()` tick while the `Viewer` reads the slices
+    file by file:
+
+    - `(PROGRESS, uid, (done, total))`
+    - `(DONE, uid, volume)`
+    - `(CANCELLED, uid, None)`
+    - `(ERROR, uid, exception)`
+
+    A cancelled series stops at its next slice, or is skipped if it is still
+    queued.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._jobs = queue.Queue()
+        self._events = queue.Queue()
+        self._cancelled = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, series, instances):
+        with self._lock:
+            self._cancelled.discard(series.SeriesInstanceUID)
+        self._jobs.put((series, instances))
+
+    def cancel(self, SeriesInstanceUID):
+        with self._lock:
+            self._cancelled.add(SeriesInstanceUID)
+
+    def poll(self):
+        """Return the events posted since the last call"""
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def close(self):
+        self._jobs.put(None)
+
+    def _is_cancelled(self, SeriesInstanceUID):
+        with self._lock:
+            return SeriesInstanceUID in self._cancelled
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            series, instances = job
+            uid = series.SeriesInstanceUID
+            try:
+                self._load(uid, instances)
+            except Exception as e:
+                self._events.put((ERROR, uid, e))
+
+    def _load(self, uid, instances):
+        if self._is_cancelled(uid):
+            self._events.put((CANCELLED, uid, None))
+            return
+        volume = self.cache.get(uid, instances, dtype=np.int16)
+        if volume is not None:
+            self._events.put((DONE, uid, volume))
+            return
+
+        def progress(done, total):
+            self._events.put((PROGRESS, uid, (done, total)))
+            return not self._is_cancelled(uid)
+
+        volume = load_series_volume(instances, progress=progress)
+        if volume is None:
+            self._events.put((CANCELLED, uid, None))
+            return
+        self._events.put((DONE, uid, volume))
+        try:
+            self.cache.put(uid, instances, to_int16(volume))
+        except OSError as e:
+            # e.g. a full disk, the volume is loaded again next time
+            logger.warning("cannot cache the volume of %s: %s", uid, e)